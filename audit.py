@@ -0,0 +1,121 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from db import insert_actions
+
+logger = logging.getLogger(__name__)
+
+# A batch is committed once it holds this many rows...
+FLUSH_ROWS = 100
+# ...or once the oldest queued row has waited this long.
+FLUSH_INTERVAL_MS = 250
+# Rows beyond this are dropped rather than blocking the handler.
+MAX_QUEUE_SIZE = 10000
+
+_STOP = object()
+
+# ------------------------- AUDIT LOG WRITER -------------------------
+
+class ActionLogWriter:
+    """
+    Background thread that drains queued audit rows into the `actions` table,
+    committing them in groups with executemany so handlers never wait on disk.
+    """
+
+    def __init__(self, flush_rows=FLUSH_ROWS, flush_interval_ms=FLUSH_INTERVAL_MS,
+                 max_queue_size=MAX_QUEUE_SIZE):
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval_ms / 1000
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.failed = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='action-log-writer', daemon=True)
+                self._thread.start()
+
+    def submit(self, telegram_id: int, action: str, details: str = ""):
+        if self._thread is None:
+            self.start()
+        try:
+            self._queue.put_nowait((telegram_id, action, details))
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self, timeout: float = 5.0):
+        """Flushes everything still queued and stops the writer thread."""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is None or not thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        thread.join(timeout)
+
+    def stats(self) -> dict:
+        return {
+            'queue_depth': self._queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped,
+            'batches': self.batches,
+            'failed': self.failed,
+        }
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.flush_rows:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+        # Drain whatever raced in after the stop marker.
+        leftover = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                leftover.append(item)
+        if leftover:
+            self._flush(leftover)
+
+    def _flush(self, batch):
+        try:
+            insert_actions(batch)
+            self.written += len(batch)
+            self.batches += 1
+        except Exception as e:
+            self.failed += len(batch)
+            logger.error(f"Failed to write {len(batch)} audit rows: {e}")
+
+
+writer = ActionLogWriter()
+atexit.register(writer.stop)
+
+
+def log_action(telegram_id: int, action: str, details: str = ""):
+    writer.submit(telegram_id, action, details)
@@ -0,0 +1,82 @@
+"""
+Per-call latency of the DB helpers: the old connect/commit/close-per-call
+pattern versus the shared connection layer in db.py.
+
+    python benchmarks/bench_db.py [--calls 2000] [--rows 10000]
+"""
+import argparse
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+
+
+def legacy_get_application_status(telegram_id):
+    conn = sqlite3.connect(db.DB_PATH)
+    c = conn.cursor()
+    c.execute('SELECT status FROM applications WHERE telegram_id = ? ORDER BY id DESC LIMIT 1',
+              (telegram_id,))
+    result = c.fetchone()
+    conn.close()
+    return result[0] if result else None
+
+
+def legacy_log_action(telegram_id, action, details=""):
+    conn = sqlite3.connect(db.DB_PATH)
+    c = conn.cursor()
+    c.execute('INSERT INTO actions (telegram_id, action, details) VALUES (?, ?, ?)',
+              (telegram_id, action, details))
+    conn.commit()
+    conn.close()
+
+
+def seed(rows):
+    with db.transaction() as conn:
+        conn.executemany(
+            'INSERT INTO applications (telegram_id, full_name, status) VALUES (?, ?, ?)',
+            ((i, f'user {i}', 'pending') for i in range(rows)),
+        )
+
+
+def measure(fn, calls, rows):
+    samples = []
+    for i in range(calls):
+        t0 = time.perf_counter()
+        fn(i % rows)
+        samples.append((time.perf_counter() - t0) * 1e6)
+    samples.sort()
+    return statistics.mean(samples), samples[len(samples) // 2], samples[int(len(samples) * 0.99)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--rows', type=int, default=10000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, 'bench.db')
+        db.init_db()
+        seed(args.rows)
+
+        cases = [
+            ('get_application_status (legacy)', legacy_get_application_status),
+            ('get_application_status (shared)', db.get_application_status),
+            ('log_action (legacy)', lambda i: legacy_log_action(i, 'bench')),
+            ('log_action (shared)', lambda i: db.insert_actions([(i, 'bench', '')])),
+        ]
+        print(f"{'case':<36}{'mean us':>10}{'p50 us':>10}{'p99 us':>10}")
+        for name, fn in cases:
+            mean, p50, p99 = measure(fn, args.calls, args.rows)
+            print(f"{name:<36}{mean:>10.1f}{p50:>10.1f}{p99:>10.1f}")
+        db.close_all()
+
+
+if __name__ == '__main__':
+    main()
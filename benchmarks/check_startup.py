@@ -0,0 +1,86 @@
+"""
+Cold start budget: time from launching the interpreter to having main
+imported and the schema checked, which is what the first request after an
+idle spin-down waits for. Exits non-zero when the median run is over budget.
+
+    python benchmarks/check_startup.py [--runs 5] [--budget-ms 900] [--top 15]
+
+The slowest imports of one run, from `python -X importtime`, are listed to
+show where a regression came from.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in a scratch directory so the relative DB_PATH never touches the
+# repository's database.
+STARTUP = f"""
+import sys, time
+sys.path.insert(0, {ROOT!r})
+t0 = time.perf_counter()
+import main
+t1 = time.perf_counter()
+main.init_db()
+t2 = time.perf_counter()
+print(f'{{(t1 - t0) * 1000:.1f}} {{(t2 - t1) * 1000:.1f}}')
+"""
+
+ENV = dict(os.environ, ADMIN_CHAT_ID='1', BOT_TOKEN='123:abc')
+
+
+def run(cwd, importtime=False):
+    args = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', STARTUP]
+    t0 = time.perf_counter()
+    proc = subprocess.run(args, cwd=cwd, env=ENV, capture_output=True, text=True, check=True)
+    wall = (time.perf_counter() - t0) * 1000
+    import_ms, init_ms = map(float, proc.stdout.split()[-2:])
+    return wall, import_ms, init_ms, proc.stderr
+
+
+def slowest_imports(stderr, top):
+    """Parses -X importtime output into (cumulative us, self us, module), slowest first."""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        entries.append((int(cumulative_us), int(self_us), module.strip()))
+    # Top-level imports only: nested ones are already counted in their parent.
+    entries = [entry for entry in entries if '.' not in entry[2]]
+    return sorted(entries, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=900,
+                        help='fail when the median start (interpreter to schema checked) exceeds this')
+    parser.add_argument('--top', type=int, default=15, help='slowest imports to list')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        run(tmp)  # creates the schema and warms the bytecode cache
+        samples = [run(tmp) for _ in range(args.runs)]
+        *_, stderr = run(tmp, importtime=True)
+
+    wall, import_ms, init_ms = (statistics.median(s[i] for s in samples) for i in range(3))
+    print(f"startup  median {wall:7.1f} ms  (import main {import_ms:.1f} ms, init_db {init_ms:.1f} ms)")
+    print(f"budget          {args.budget_ms:7.1f} ms\n")
+    print(f"{'module':32} {'cumulative ms':>14} {'self ms':>9}")
+    for cumulative_us, self_us, module in slowest_imports(stderr, args.top):
+        print(f"{module:32} {cumulative_us / 1000:14.1f} {self_us / 1000:9.1f}")
+
+    if wall > args.budget_ms:
+        print(f"\nFAIL: startup {wall:.1f} ms is over the {args.budget_ms:.0f} ms budget")
+        sys.exit(1)
+    print("\nOK")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Builds a synthetic applications.db for benchmarking.
+
+    python benchmarks/gen_db.py --applicants 100000 --out /tmp/bench.db
+
+About REAPPLY_RATE of applicants submit a second application, and each
+applicant leaves ACTIONS_PER_APPLICANT audit rows.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+
+SIZES = {'10k': 10_000, '100k': 100_000, '1m': 1_000_000}
+REAPPLY_RATE = 0.1
+ACTIONS_PER_APPLICANT = 3
+STATUSES = ['pending', 'pending', 'pending', 'accepted ✅', 'rejected ❌']
+CONNECTIONS = ['>100', '>200', '>300', '>400', '>500', '>600', '700-1000']
+ACTIONS = ['list_users', 'paginate_users', 'approve_user', 'reject_user']
+
+# Synthetic telegram ids start here so they never collide with real ones.
+FIRST_TELEGRAM_ID = 10_000_000
+CHUNK = 50_000
+
+
+def _applications(count, rng):
+    for i in range(count):
+        telegram_id = FIRST_TELEGRAM_ID + i
+        connections = rng.choice(CONNECTIONS)
+        yield (telegram_id, f'Applicant {i}', f'+2519{i:08d}', f'https://linkedin.com/in/applicant-{i}',
+               'x', connections, 7.0, rng.choice(STATUSES))
+    for i in rng.sample(range(count), int(count * REAPPLY_RATE)):
+        yield (FIRST_TELEGRAM_ID + i, f'Applicant {i}', f'+2519{i:08d}',
+               f'https://linkedin.com/in/applicant-{i}', 'x', '>200', 10.0, 'pending')
+
+
+def _actions(count, rng):
+    for i in range(count * ACTIONS_PER_APPLICANT):
+        yield (FIRST_TELEGRAM_ID + rng.randrange(count), rng.choice(ACTIONS), f'Page {rng.randrange(100)}')
+
+
+def _chunks(rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def generate(path: str, applicants: int, seed: int = 1):
+    if os.path.exists(path):
+        os.remove(path)
+    db.DB_PATH = path
+    db.init_db()
+    rng = random.Random(seed)
+    for chunk in _chunks(_applications(applicants, rng)):
+        with db.transaction() as conn:
+            conn.executemany('''INSERT INTO applications (
+                                telegram_id, full_name, phone, linkedin_account,
+                                password, connections, weekly_earning, status
+                             ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', chunk)
+    for chunk in _chunks(_actions(applicants, rng)):
+        db.insert_actions(chunk)
+    db.get_connection().execute('ANALYZE')
+    db.close_all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--applicants', default='10k',
+                        help=f"number of applicants or one of {', '.join(SIZES)}")
+    parser.add_argument('--out', required=True)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    applicants = SIZES.get(args.applicants.lower()) or int(args.applicants)
+    t0 = time.perf_counter()
+    generate(args.out, applicants, args.seed)
+    print(f"Wrote {applicants} applicants to {args.out} in {time.perf_counter() - t0:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,397 @@
+"""
+Replays recorded Telegram updates through the real handlers and reports
+per-handler latency percentiles and SQLite statements per call.
+
+    python benchmarks/replay.py --db /tmp/bench.db [--updates benchmarks/updates.jsonl]
+    python benchmarks/replay.py --db /tmp/bench.db --generate 500 [--write updates.jsonl]
+    python benchmarks/replay.py --generate 2000 --workers 8 --latency-ms 50
+    python benchmarks/replay.py --generate 20000 --shards 1,2,4
+
+Updates are JSON objects as Telegram posts them to the webhook, one per line.
+Bot API calls go to a RecordingBot that answers locally instead of hitting
+the network. Use gen_db.py to build databases of 10k/100k/1M applicants.
+With --shards the updates go through webhook.ShardedIngestor once per
+shard count, and only throughput is reported. The replay exits with status
+1 if any handler raised or any queued Bot API call failed.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from collections import Counter, defaultdict
+from functools import partial
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ADMIN_ID = 1000
+os.environ.setdefault('ADMIN_CHAT_ID', str(ADMIN_ID))
+warnings.filterwarnings('ignore', module='telegram')
+
+from telegram import Bot, Update  # noqa: E402
+from telegram.ext import ConversationHandler  # noqa: E402
+
+import audit  # noqa: E402
+import db  # noqa: E402
+from callbacks import CallbackRouter  # noqa: E402
+import outbound  # noqa: E402
+from webhook import ShardedIngestor  # noqa: E402
+
+FIRST_TELEGRAM_ID = 10_000_000
+DEFAULT_UPDATES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'updates.jsonl')
+
+# ------------------------- STUBBED BOT -------------------------
+
+class RecordingBot(Bot):
+    """Bot whose API calls are recorded and answered locally."""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__('123456:replay')
+        self.latency = latency
+        self.calls = defaultdict(int)
+        self._message_ids = iter(range(1, 1 << 62))
+        self._lock = threading.Lock()
+
+    def _post(self, endpoint, data=None, timeout=None, api_kwargs=None):
+        with self._lock:
+            self.calls[endpoint] += 1
+            message_id = next(self._message_ids)
+        if self.latency and endpoint != 'getMe':
+            time.sleep(self.latency)
+        if endpoint == 'getMe':
+            return {'id': 123456, 'is_bot': True, 'first_name': 'Replay', 'username': 'replay_bot'}
+        if endpoint in ('sendMessage', 'sendPhoto', 'sendDocument', 'editMessageText', 'editMessageCaption'):
+            chat_id = (data or {}).get('chat_id', 0)
+            message = {'message_id': message_id, 'date': int(time.time()),
+                       'chat': {'id': chat_id, 'type': 'private'}}
+            if endpoint == 'sendPhoto':
+                message['photo'] = [{'file_id': 'replay-photo', 'file_unique_id': 'replay',
+                                     'width': 1, 'height': 1}]
+            return message
+        return True
+
+# ------------------------- UPDATES -------------------------
+
+def _user(telegram_id):
+    return {'id': telegram_id, 'is_bot': False, 'first_name': f'User{telegram_id}'}
+
+
+def _chat(telegram_id):
+    return {'id': telegram_id, 'type': 'private'}
+
+
+def _command(update_id, telegram_id, text):
+    command = text.split()[0]
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 1700000000, 'chat': _chat(telegram_id),
+        'from': _user(telegram_id), 'text': text,
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}],
+    }}
+
+
+def _callback(update_id, telegram_id, data, text=None, caption=None):
+    message = {'message_id': update_id, 'date': 1700000000, 'chat': _chat(telegram_id)}
+    if caption is not None:
+        message['caption'] = caption
+    else:
+        message['text'] = text or 'Users'
+    return {'update_id': update_id, 'callback_query': {
+        'id': str(update_id), 'from': _user(telegram_id), 'chat_instance': str(telegram_id),
+        'data': data, 'message': message,
+    }}
+
+
+def generate_updates(count: int, applicants: int, seed: int = 1, admin_share: float = 0.5):
+    """
+    A mix of user menu traffic and admin review traffic against gen_db.py ids;
+    `admin_share` of the draws are admin updates (a low share models a spike).
+    """
+    import main
+
+    rng = random.Random(seed)
+    updates = []
+    update_id = 1
+    while len(updates) < count:
+        roll = rng.random()
+        telegram_id = FIRST_TELEGRAM_ID + rng.randrange(max(applicants, 1))
+        admin_roll = (roll - (1 - admin_share)) / admin_share if admin_share else -1
+        if admin_roll < 0:
+            updates.append(_command(update_id, telegram_id, '/start'))
+            update_id += 1
+            updates.append(_callback(update_id, telegram_id, 'main_menu', caption='Welcome'))
+        elif admin_roll < 0.4:
+            updates.append(_command(update_id, ADMIN_ID, '/users'))
+        elif admin_roll < 0.8:
+            cursor = rng.randrange(1, max(applicants, 2))
+            updates.append(_callback(update_id, ADMIN_ID, main.USERS_PAGE.encode('next', 1, cursor)))
+        else:
+            action = rng.choice(['approve', 'reject'])
+            updates.append(_callback(update_id, ADMIN_ID, main.REVIEW.encode(action, telegram_id)))
+        update_id += 1
+    return updates[:count]
+
+
+def load_updates(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# ------------------------- INSTRUMENTATION -------------------------
+
+_statements = threading.local()
+
+
+def _count_statements(conn):
+    def trace(_):
+        _statements.count = getattr(_statements, 'count', 0) + 1
+    conn.set_trace_callback(trace)
+
+
+def _timed(callback, samples, db_calls, errors):
+    name = callback.__name__
+
+    def timed(update, context, *args):
+        before = getattr(_statements, 'count', 0)
+        t0 = time.perf_counter()
+        try:
+            return callback(update, context, *args)
+        except Exception:
+            errors[name] += 1
+            raise
+        finally:
+            samples[name].append(time.perf_counter() - t0)
+            db_calls[name] += getattr(_statements, 'count', 0) - before
+    return timed
+
+
+def _instrument(handler, samples, db_calls, errors):
+    if isinstance(handler, ConversationHandler):
+        for child in handler.entry_points + handler.fallbacks:
+            _instrument(child, samples, db_calls, errors)
+        for children in handler.states.values():
+            for child in children:
+                _instrument(child, samples, db_calls, errors)
+        return
+    router = getattr(handler.callback, '__self__', None)
+    if isinstance(router, CallbackRouter):
+        # Time the handlers buttons are routed to rather than the router.
+        for code, callback in router.handlers.items():
+            router.handlers[code] = _timed(callback, samples, db_calls, errors)
+        return
+    handler.callback = _timed(handler.callback, samples, db_calls, errors)
+
+
+def _percentile(sorted_samples, pct):
+    index = min(int(len(sorted_samples) * pct / 100), len(sorted_samples) - 1)
+    return sorted_samples[index]
+
+
+def replay(updates, throttle=False, workers=0, latency=0.0, send_threads=outbound.SEND_THREADS, lanes=False):
+    """
+    Runs `updates` through the dispatcher. With workers=0 they are processed
+    one by one on this thread; otherwise through webhook.UpdateIngestor with
+    that many workers, the way the webhook does. `latency` is added to every
+    Bot API call to model the network round trip; `send_threads` sizes the
+    send scheduler that carries those calls. With `lanes` the ingestor sorts
+    updates into main.classify_update's priority lanes and sheds like the
+    webhook does; either way the time updates spent queued and processed is
+    reported per lane. The returned errors count handler exceptions by
+    handler, and Bot API calls the send scheduler failed under 'Bot API'.
+    """
+    import main
+    from webhook import UpdateIngestor, payload_chat_id
+
+    connect = db._connect
+
+    def counting_connect(path):
+        conn = connect(path)
+        _count_statements(conn)
+        return conn
+    db._connect = counting_connect
+    db.close_all()
+
+    if not throttle:
+        outbound.scheduler = outbound.SendScheduler(global_rate=1e9, global_burst=1e9,
+                                                    chat_rate=1e9, chat_burst=1e9, threads=send_threads)
+    bot = RecordingBot(latency)
+    main.bot = bot
+    dispatcher = main.build_dispatcher(bot)
+    routes = dict(main.router.handlers)
+    samples = defaultdict(list)
+    db_calls = defaultdict(int)
+    errors = Counter()
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            _instrument(handler, samples, db_calls, errors)
+
+    waits = defaultdict(list)
+    shed = Counter()
+    t0 = time.perf_counter()
+    if workers:
+        # Items are (payload, submitted at) so the wait can be reported per lane.
+        def process(item):
+            payload, submitted = item
+            dispatcher.process_update(Update.de_json(payload, bot))
+            waits[main.classify_update(payload)[0]].append(time.perf_counter() - submitted)
+
+        if lanes:
+            ingestor = UpdateIngestor(process, workers=workers, max_queue=main.WEBHOOK_QUEUE_SIZE,
+                                      classify=lambda item: main.classify_update(item[0]),
+                                      shed=lambda item, reason: main.shed_update(item[0], reason),
+                                      chat_of=lambda item: payload_chat_id(item[0]))
+        else:
+            ingestor = UpdateIngestor(process, workers=workers, max_queue=len(updates) + 1,
+                                      chat_of=lambda item: payload_chat_id(item[0]))
+        ingestor.start()
+        for payload in updates:
+            ingestor.submit((payload, time.perf_counter()))
+        ingestor.stop(timeout=None)
+        shed = ingestor.shed_counts
+    else:
+        for payload in updates:
+            dispatcher.process_update(Update.de_json(payload, bot))
+    # Work handed to the send scheduler counts towards the run.
+    outbound.scheduler.stop()
+    elapsed = time.perf_counter() - t0
+    if outbound.scheduler.failed:
+        errors['Bot API'] = outbound.scheduler.failed
+    audit.writer.stop()
+    db._connect = connect
+    main.router.handlers.update(routes)
+    return samples, db_calls, elapsed, bot.calls, waits, shed, errors
+
+
+def _replay_lane(db_path, latency, lane, lanes):
+    """ShardedIngestor setup for replay: a RecordingBot dispatcher in each worker process."""
+    import main
+
+    db.DB_PATH = db_path
+    outbound.scheduler = outbound.SendScheduler(global_rate=1e9, global_burst=1e9,
+                                                chat_rate=1e9, chat_burst=1e9)
+    bot = RecordingBot(latency)
+    dispatcher = main.build_dispatcher(bot)
+    errors = []
+    dispatcher.add_error_handler(lambda update, context: errors.append(context.error))
+
+    def process(payload):
+        dispatcher.process_update(Update.de_json(payload, bot))
+        # The dispatcher swallows handler exceptions; count them as failed updates.
+        if errors:
+            raise errors.pop()
+
+    def teardown():
+        outbound.scheduler.stop()
+        audit.writer.stop()
+        if outbound.scheduler.failed:
+            print(f"[{lane}] {outbound.scheduler.failed} Bot API call(s) failed", file=sys.stderr)
+
+    return process, teardown
+
+
+def replay_sharded(updates, shards, latency=0.0):
+    """
+    Runs `updates` through a ShardedIngestor with `shards` user processes plus
+    the admin lane. Timing starts once every worker has built its dispatcher.
+    Returns the elapsed time, the number of updates each lane got and the
+    number of updates that failed.
+    """
+    ingestor = ShardedIngestor(partial(_replay_lane, db.DB_PATH, latency), shards=shards,
+                               admin_chat_id=ADMIN_ID, max_queue=len(updates) + 1)
+    ingestor.start()
+    t0 = time.perf_counter()
+    for payload in updates:
+        ingestor.submit(payload)
+    ingestor.stop(timeout=None)
+    elapsed = time.perf_counter() - t0
+    lanes = Counter(ingestor.lanes[ingestor.lane_for(payload)] for payload in updates)
+    return elapsed, lanes, ingestor.stats()['failed']
+
+
+def report(samples, db_calls, elapsed, api_calls, total, waits=None, shed=None, errors=None):
+    print(f"Replayed {total} updates in {elapsed:.2f}s ({total / elapsed:.0f} updates/s)\n")
+    print(f"{'handler':<26}{'calls':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'db/call':>9}")
+    for name in sorted(samples):
+        values = sorted(samples[name])
+        print(f"{name:<26}{len(values):>7}"
+              f"{_percentile(values, 50) * 1000:>9.2f}"
+              f"{_percentile(values, 95) * 1000:>9.2f}"
+              f"{_percentile(values, 99) * 1000:>9.2f}"
+              f"{db_calls[name] / len(values):>9.1f}")
+    if waits:
+        print(f"\n{'lane (queued + run)':<26}{'updates':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+        for lane in sorted(waits):
+            values = sorted(waits[lane])
+            print(f"{lane:<26}{len(values):>7}"
+                  f"{_percentile(values, 50) * 1000:>9.2f}"
+                  f"{_percentile(values, 95) * 1000:>9.2f}"
+                  f"{_percentile(values, 99) * 1000:>9.2f}")
+    if shed:
+        print("\nShed: " + ', '.join(f"{lane}/{reason}={count}" for (lane, reason), count in sorted(shed.items())))
+    print("\nBot API calls: " + ', '.join(f"{k}={v}" for k, v in sorted(api_calls.items())))
+    if errors:
+        print("\nErrors: " + ', '.join(f"{name}={count}" for name, count in sorted(errors.items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--db', help='database to replay against (copied first); defaults to an empty one')
+    parser.add_argument('--updates', default=DEFAULT_UPDATES)
+    parser.add_argument('--generate', type=int, help='synthesize this many updates instead of reading --updates')
+    parser.add_argument('--applicants', type=int, default=10_000,
+                        help='applicant count the generated updates should target')
+    parser.add_argument('--admin-share', type=float, default=0.5,
+                        help='share of generated draws that are admin updates')
+    parser.add_argument('--write', help='save the generated updates to this JSONL file')
+    parser.add_argument('--throttle', action='store_true', help='keep the real outbound rate limits')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='process through an UpdateIngestor with this many workers (0: sequential)')
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help='simulated network latency added to every Bot API call')
+    parser.add_argument('--lanes', action='store_true',
+                        help='with --workers, use the priority lanes and shedding of the webhook')
+    parser.add_argument('--shards', help='comma-separated shard counts to compare, e.g. 1,2,4')
+    parser.add_argument('--send-threads', type=int, default=outbound.SEND_THREADS,
+                        help='send scheduler threads for the unthrottled run')
+    args = parser.parse_args()
+
+    if args.generate:
+        updates = generate_updates(args.generate, args.applicants, admin_share=args.admin_share)
+        if args.write:
+            with open(args.write, 'w') as f:
+                for payload in updates:
+                    f.write(json.dumps(payload) + '\n')
+    else:
+        updates = load_updates(args.updates)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, 'replay.db')
+        if args.db:
+            shutil.copyfile(args.db, db.DB_PATH)
+        db.init_db()
+        if args.shards:
+            failed = 0
+            for shards in map(int, args.shards.split(',')):
+                elapsed, lanes, run_failed = replay_sharded(updates, shards, latency=args.latency_ms / 1000)
+                split = ', '.join(f"{lane}={count}" for lane, count in sorted(lanes.items()))
+                print(f"{shards} shard(s): {len(updates)} updates in {elapsed:.2f}s "
+                      f"({len(updates) / elapsed:.0f} updates/s)  [{split}]"
+                      + (f"  {run_failed} failed" if run_failed else ''))
+                failed += run_failed
+            if failed:
+                sys.exit(1)
+            return
+        samples, db_calls, elapsed, api_calls, waits, shed, errors = replay(
+            updates, throttle=args.throttle, workers=args.workers, latency=args.latency_ms / 1000,
+            send_threads=args.send_threads, lanes=args.lanes)
+        db.close_all()
+    report(samples, db_calls, elapsed, api_calls, len(updates), waits, shed, errors)
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
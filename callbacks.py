@@ -0,0 +1,136 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Bumped when the payload layout changes; buttons from older layouts decode
+# as expired instead of reaching a handler with the wrong arguments.
+VERSION = '1'
+
+SEPARATOR = ':'
+
+# Telegram rejects inline buttons whose callback_data is longer than this.
+MAX_BYTES = 64
+
+_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def _to_base36(value: int) -> str:
+    if value < 0:
+        return '-' + _to_base36(-value)
+    digits = ''
+    while True:
+        value, digit = divmod(value, 36)
+        digits = _DIGITS[digit] + digits
+        if not value:
+            return digits
+
+
+class Action:
+    """
+    A kind of button press: a short code plus the types of its arguments
+    (int or str). Ints travel in base 36, which keeps Telegram ids to 8-11
+    characters.
+    """
+
+    def __init__(self, code: str, name: str, types: tuple):
+        self.code = code
+        self.name = name
+        self.types = types
+
+    def encode(self, *values) -> str:
+        """Returns the callback_data for this action with `values` as its arguments."""
+        if len(values) != len(self.types):
+            raise ValueError(f"{self.name} takes {len(self.types)} argument(s), got {len(values)}")
+        parts = [VERSION + self.code]
+        for kind, value in zip(self.types, values):
+            if kind is int:
+                parts.append(_to_base36(value))
+            else:
+                value = str(value)
+                if not value or SEPARATOR in value:
+                    raise ValueError(f"{self.name}: {value!r} can't be encoded")
+                parts.append(value)
+        data = SEPARATOR.join(parts)
+        if len(data.encode()) > MAX_BYTES:
+            raise ValueError(f"{self.name}: callback data is over {MAX_BYTES} bytes: {data!r}")
+        return data
+
+    def __repr__(self):
+        return f"Action({self.code!r}, {self.name!r})"
+
+
+class CallbackRouter:
+    """
+    Registry of inline button actions and the one handler each routes to.
+
+    Reusing a code or name, or routing an action to a second handler, raises,
+    so a duplicate definition can't silently take over an action. dispatch() is a single
+    CallbackQueryHandler callback that decodes the payload and finds the
+    handler with one dict lookup; payloads it can't decode go to the fallback.
+    """
+
+    def __init__(self):
+        self.actions = {}
+        self.handlers = {}
+        self.fallback = None
+
+    def action(self, code: str, name: str, *types) -> Action:
+        if not code or SEPARATOR in code:
+            raise ValueError(f"Invalid action code {code!r}")
+        if code in self.actions:
+            raise ValueError(f"Action code {code!r} is already used by {self.actions[code].name}")
+        if any(action.name == name for action in self.actions.values()):
+            raise ValueError(f"Action {name!r} is already registered")
+        for kind in types:
+            if kind not in (int, str):
+                raise ValueError(f"{name}: unsupported argument type {kind!r}")
+        action = Action(code, name, types)
+        self.actions[code] = action
+        return action
+
+    def handles(self, *actions):
+        """Decorator routing `actions` to the decorated handler, called as
+        handler(update, context, *arguments)."""
+        def register(handler):
+            for action in actions:
+                if self.actions.get(action.code) is not action:
+                    raise ValueError(f"{action!r} was not registered with this router")
+                if action.code in self.handlers:
+                    raise ValueError(f"{action.name} is already routed to "
+                                     f"{self.handlers[action.code].__name__}")
+                self.handlers[action.code] = handler
+            return handler
+        return register
+
+    def unknown(self, handler):
+        """Decorator for the handler of expired or unrecognised payloads."""
+        self.fallback = handler
+        return handler
+
+    def unrouted(self) -> list:
+        """Actions that no handler has been registered for."""
+        return [action for code, action in self.actions.items() if code not in self.handlers]
+
+    def decode(self, data):
+        """Returns (action, arguments), or None for a payload this version can't read."""
+        if not data or data[0] != VERSION:
+            return None
+        code, *raw = data[1:].split(SEPARATOR)
+        action = self.actions.get(code)
+        if action is None or len(raw) != len(action.types):
+            return None
+        try:
+            arguments = [int(value, 36) if kind is int else value for kind, value in zip(action.types, raw)]
+        except ValueError:
+            return None
+        return action, arguments
+
+    def dispatch(self, update, context):
+        decoded = self.decode(update.callback_query.data)
+        handler = self.handlers.get(decoded[0].code) if decoded else None
+        if handler is None:
+            if self.fallback is None:
+                logger.warning(f"Unroutable callback data {update.callback_query.data!r}")
+                return None
+            return self.fallback(update, context)
+        return handler(update, context, *decoded[1])
@@ -0,0 +1,433 @@
+import logging
+import re
+import sqlite3
+import threading
+import time
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+from cache import TTLCache, MISSING
+from migrations import MIGRATIONS, SCHEMA_VERSION
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = 'applications.db'
+
+# Milliseconds a connection waits on a locked database before raising
+# "database is locked".
+BUSY_TIMEOUT_MS = 5000
+
+# Number of compiled statements each connection keeps around for reuse.
+STATEMENT_CACHE_SIZE = 128
+
+# Latest application status per telegram_id. The writers below keep it in
+# step, so the TTL only bounds how long an out-of-band edit can go unseen.
+STATUS_CACHE_SIZE = 10000
+STATUS_CACHE_TTL = 3600
+
+status_cache = TTLCache(maxsize=STATUS_CACHE_SIZE, ttl=STATUS_CACHE_TTL)
+
+# ------------------------- CONNECTION MANAGER -------------------------
+
+_local = threading.local()
+# Weak, so connections of threads that have exited aren't kept open here.
+_connections = weakref.WeakSet()
+_connections_lock = threading.Lock()
+# Bumped by close_all so threads notice their cached connection is gone.
+_generation = 0
+
+
+# Callables invoked as observer(sql, seconds) after every statement run through
+# a managed connection (metrics, profiling). Empty means no timing overhead.
+query_observers = []
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection that reports each execute/executemany to query_observers."""
+
+    def execute(self, sql, parameters=()):
+        if not query_observers:
+            return super().execute(sql, parameters)
+        t0 = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _notify(sql, time.perf_counter() - t0)
+
+    def executemany(self, sql, seq_of_parameters):
+        if not query_observers:
+            return super().executemany(sql, seq_of_parameters)
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _notify(sql, time.perf_counter() - t0)
+
+
+def _notify(sql, seconds):
+    for observer in query_observers:
+        try:
+            observer(sql, seconds)
+        except Exception as e:
+            logger.warning(f"Query observer failed: {e}")
+
+
+def _configure(conn: sqlite3.Connection):
+    # Only takes effect on a brand-new file (before WAL initialises it); lets
+    # retention.py return freed pages without a full VACUUM. No-op otherwise.
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    conn.execute('PRAGMA journal_mode=WAL')
+    # WAL + NORMAL only fsyncs on checkpoint, which is durable across
+    # application crashes and cheap enough to do on every handler.
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+    conn.execute('PRAGMA foreign_keys=ON')
+    conn.execute('PRAGMA temp_store=MEMORY')
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        path,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        factory=TimedConnection,
+    )
+    _configure(conn)
+    with _connections_lock:
+        _connections.add(conn)
+    return conn
+
+
+class _ThreadConnection:
+    """
+    A thread's connection, held in thread-local storage. Thread-locals are
+    released as soon as their thread exits, and this closes the connection
+    then instead of waiting for the garbage collector (Flask serves each
+    request on a new thread).
+    """
+
+    def __init__(self, conn: sqlite3.Connection, key):
+        self.conn = conn
+        self.key = key
+
+    def __del__(self):
+        try:
+            self.conn.close()
+        except sqlite3.Error:
+            pass
+
+
+def get_connection() -> sqlite3.Connection:
+    """
+    Returns the calling thread's connection to DB_PATH, opening it on first use.
+    Connections stay open for the lifetime of the thread, so repeated calls
+    reuse the same prepared statement cache.
+    """
+    held = getattr(_local, 'held', None)
+    if held is not None and held.key == (DB_PATH, _generation):
+        return held.conn
+    _local.held = held = _ThreadConnection(_connect(DB_PATH), (DB_PATH, _generation))
+    return held.conn
+
+
+@contextmanager
+def transaction():
+    """
+    Yields the thread's connection and commits on success, rolls back on error.
+    """
+    conn = get_connection()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def close_all():
+    """Closes every connection opened by get_connection (used on shutdown)."""
+    global _generation
+    with _connections_lock:
+        conns = list(_connections)
+        _connections.clear()
+        _generation += 1
+    for conn in conns:
+        try:
+            conn.close()
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to close connection: {e}")
+
+# ------------------------- BACKGROUND QUERIES -------------------------
+
+# Long-running reads (exports) run on this thread instead of an update worker.
+# Hot-path lookups stay synchronous: they are single index probes, cheaper
+# than handing them to another thread.
+_background = None
+_background_lock = threading.Lock()
+
+
+def run_in_background(fn, /, *args, **kwargs) -> Future:
+    """Runs fn(*args, **kwargs) on the dedicated database thread and returns its Future."""
+    global _background
+    with _background_lock:
+        if _background is None:
+            _background = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-background')
+    return _background.submit(fn, *args, **kwargs)
+
+# ------------------------- DATABASE FUNCTIONS -------------------------
+
+def schema_version() -> int:
+    return get_connection().execute('PRAGMA user_version').fetchone()[0]
+
+
+def init_db():
+    """
+    Brings the schema up to SCHEMA_VERSION by applying every migration newer
+    than the database's user_version, each in its own transaction.
+    """
+    current = schema_version()
+    if current >= SCHEMA_VERSION:
+        return
+    conn = get_connection()
+    for version, statements in MIGRATIONS:
+        if version <= current:
+            continue
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Another process may have migrated while we waited for the lock.
+            if conn.execute('PRAGMA user_version').fetchone()[0] >= version:
+                conn.rollback()
+                continue
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version={version}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logger.info(f"Applied schema migration {version}")
+
+
+def explain(sql: str, params=()) -> list:
+    """Returns the detail column of EXPLAIN QUERY PLAN for a statement."""
+    return [row[3] for row in get_connection().execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+
+
+def insert_actions(rows):
+    """Inserts (telegram_id, action, details) rows into the audit log in one commit."""
+    with transaction() as conn:
+        conn.executemany('''INSERT INTO actions (telegram_id, action, details) VALUES (?, ?, ?)''',
+                         rows)
+
+
+def save_application(data: dict):
+    with transaction() as conn:
+        conn.execute('''INSERT INTO applications (
+                        telegram_id, full_name, phone, linkedin_account,
+                        password, connections, weekly_earning, status
+                     ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                     (
+                         data.get('telegram_id'),
+                         data.get('full_name'),
+                         data.get('phone'),
+                         data.get('linkedin_account'),
+                         data.get('password'),
+                         data.get('connections'),
+                         data.get('weekly_earning'),
+                         'pending'
+                     ))
+    status_cache.set(data.get('telegram_id'), 'pending')
+    invalidate_applicant_count()
+
+
+UPDATE_STATUS_SQL = '''
+    UPDATE applications
+    SET status = ?
+    WHERE telegram_id = ?
+    AND id = (
+        SELECT MAX(id)
+        FROM applications
+        WHERE telegram_id = ?
+    )
+'''
+
+APPLICATION_STATUS_SQL = '''
+    SELECT status
+    FROM applications
+    WHERE telegram_id = ?
+    ORDER BY id DESC
+    LIMIT 1
+'''
+
+
+def update_application_status(telegram_id: int, new_status: str):
+    with transaction() as conn:
+        updated = conn.execute(UPDATE_STATUS_SQL, (new_status, telegram_id, telegram_id)).rowcount
+    if updated:
+        status_cache.set(telegram_id, new_status)
+
+
+def bulk_update_application_status(telegram_ids, new_status: str) -> list:
+    """
+    Sets the latest application of every user in `telegram_ids` to `new_status`
+    in a single transaction. Returns the ids that actually had an application.
+    """
+    updated = []
+    with transaction() as conn:
+        for telegram_id in telegram_ids:
+            if conn.execute(UPDATE_STATUS_SQL, (new_status, telegram_id, telegram_id)).rowcount:
+                updated.append(telegram_id)
+    for telegram_id in updated:
+        status_cache.set(telegram_id, new_status)
+    return updated
+
+
+def get_application_status(telegram_id: int) -> str:
+    status = status_cache.get(telegram_id)
+    if status is not MISSING:
+        return status
+    result = get_connection().execute(APPLICATION_STATUS_SQL, (telegram_id,)).fetchone()
+    status = result[0] if result else None
+    status_cache.add(telegram_id, status)
+    return status
+
+
+# An applicant is the newest application row for each telegram_id.
+LATEST_APPLICATION_FILTER = '''
+    id = (SELECT MAX(id) FROM applications AS newer WHERE newer.telegram_id = applications.telegram_id)
+'''
+
+APPLICANTS_BEFORE_SQL = f'''
+    SELECT id, telegram_id, full_name
+    FROM applications
+    WHERE id < ? AND {LATEST_APPLICATION_FILTER}
+    ORDER BY id DESC
+    LIMIT ?
+'''
+
+APPLICANTS_AFTER_SQL = f'''
+    SELECT id, telegram_id, full_name
+    FROM applications
+    WHERE id > ? AND {LATEST_APPLICATION_FILTER}
+    ORDER BY id ASC
+    LIMIT ?
+'''
+
+SEARCH_BEFORE_SQL = f'''
+    SELECT applications.id, applications.telegram_id, applications.full_name
+    FROM applications_fts
+    JOIN applications ON applications.id = applications_fts.rowid
+    WHERE applications_fts MATCH ? AND applications_fts.rowid < ? AND {LATEST_APPLICATION_FILTER}
+    ORDER BY applications_fts.rowid DESC
+    LIMIT ?
+'''
+
+SEARCH_AFTER_SQL = f'''
+    SELECT applications.id, applications.telegram_id, applications.full_name
+    FROM applications_fts
+    JOIN applications ON applications.id = applications_fts.rowid
+    WHERE applications_fts MATCH ? AND applications_fts.rowid > ? AND {LATEST_APPLICATION_FILTER}
+    ORDER BY applications_fts.rowid ASC
+    LIMIT ?
+'''
+
+_SEARCH_TOKEN = re.compile(r'\w+', re.UNICODE)
+
+# Seconds the applicant count is reused before it is recounted.
+APPLICANT_COUNT_TTL = 60
+
+_applicant_count = None
+_applicant_count_expires = 0.0
+
+
+def get_applicants_page(before_id: int = None, after_id: int = None, limit: int = 5):
+    """
+    Returns up to `limit` applicants as (id, telegram_id, full_name), newest first,
+    plus whether more rows exist beyond the page in the direction travelled.
+    Pass the last id of the current page as `before_id` to go forward, or the
+    first id as `after_id` to go back. Cost depends on the page size, not on
+    the table size.
+    """
+    conn = get_connection()
+    if after_id is not None:
+        rows = conn.execute(APPLICANTS_AFTER_SQL, (after_id, limit + 1)).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+    else:
+        cursor = before_id if before_id is not None else 2 ** 63 - 1
+        rows = conn.execute(APPLICANTS_BEFORE_SQL, (cursor, limit + 1)).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+    return rows, more
+
+
+def fts_query(text: str) -> str:
+    """
+    Turns free text into an FTS5 query that prefix-matches every word, quoting
+    each token so user input can't inject FTS syntax. Empty if no words.
+    """
+    return ' '.join(f'"{token}"*' for token in _SEARCH_TOKEN.findall(text))
+
+
+def search_applicants(text: str, before_id: int = None, after_id: int = None, limit: int = 5):
+    """
+    Like get_applicants_page, but restricted to applicants whose name, LinkedIn
+    account or telegram id prefix-matches every word in `text`.
+    """
+    match = fts_query(text)
+    if not match:
+        return [], False
+    conn = get_connection()
+    if after_id is not None:
+        rows = conn.execute(SEARCH_AFTER_SQL, (match, after_id, limit + 1)).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+    else:
+        cursor = before_id if before_id is not None else 2 ** 63 - 1
+        rows = conn.execute(SEARCH_BEFORE_SQL, (match, cursor, limit + 1)).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+    return rows, more
+
+
+def count_applicants() -> int:
+    """Number of distinct applicants, recounted at most every APPLICANT_COUNT_TTL seconds."""
+    global _applicant_count, _applicant_count_expires
+    now = time.monotonic()
+    if _applicant_count is None or now >= _applicant_count_expires:
+        _applicant_count = get_connection().execute(
+            'SELECT COUNT(DISTINCT telegram_id) FROM applications'
+        ).fetchone()[0]
+        _applicant_count_expires = now + APPLICANT_COUNT_TTL
+    return _applicant_count
+
+
+def invalidate_applicant_count():
+    global _applicant_count
+    _applicant_count = None
+
+
+def get_media_file_id(file_hash: str) -> str:
+    result = get_connection().execute(
+        'SELECT file_id FROM media_cache WHERE file_hash = ?', (file_hash,)
+    ).fetchone()
+    return result[0] if result else None
+
+
+def save_media_file_id(file_hash: str, path: str, file_id: str):
+    with transaction() as conn:
+        conn.execute('''INSERT INTO media_cache (file_hash, path, file_id) VALUES (?, ?, ?)
+                        ON CONFLICT(file_hash) DO UPDATE SET
+                            path = excluded.path,
+                            file_id = excluded.file_id,
+                            updated_at = CURRENT_TIMESTAMP''',
+                     (file_hash, path, file_id))
+
+
+def delete_media_file_id(file_hash: str):
+    with transaction() as conn:
+        conn.execute('DELETE FROM media_cache WHERE file_hash = ?', (file_hash,))
@@ -0,0 +1,108 @@
+"""
+Streams the applications table or the actions audit log as CSV or JSONL.
+
+    python export.py applications --format csv --gzip -o applications.csv.gz
+    python export.py actions --format jsonl > actions.jsonl
+
+Rows are read with fetchmany in CHUNK_ROWS chunks and written as they are
+produced, so memory stays flat regardless of table size. Credential columns
+are never exported.
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+import zlib
+
+import db
+
+CHUNK_ROWS = 1000
+
+# Explicit allowlists: a column added later is not exported until listed here.
+# applications.password is a credential and must never appear.
+EXPORT_COLUMNS = {
+    'applications': ('id', 'telegram_id', 'full_name', 'phone', 'linkedin_account',
+                     'connections', 'weekly_earning', 'status'),
+    'actions': ('id', 'telegram_id', 'action', 'details', 'timestamp'),
+}
+FORMATS = ('csv', 'jsonl')
+
+
+def iter_rows(table: str, chunk_rows: int = CHUNK_ROWS):
+    columns = EXPORT_COLUMNS[table]
+    cursor = db.get_connection().execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY id")
+    while True:
+        rows = cursor.fetchmany(chunk_rows)
+        if not rows:
+            return
+        yield rows
+
+
+def iter_export(table: str, fmt: str = 'csv', compress: bool = False):
+    """Yields the export as byte chunks, one per fetched batch of rows."""
+    if table not in EXPORT_COLUMNS:
+        raise ValueError(f"Unknown table: {table}")
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format: {fmt}")
+    columns = EXPORT_COLUMNS[table]
+    # wbits=31 produces a gzip stream
+    compressor = zlib.compressobj(wbits=31) if compress else None
+
+    def emit(text):
+        data = text.encode('utf-8')
+        return compressor.compress(data) if compressor else data
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == 'csv' else None
+    if writer:
+        writer.writerow(columns)
+    for rows in iter_rows(table):
+        if writer:
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                buffer.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+                buffer.write('\n')
+        chunk = emit(buffer.getvalue())
+        buffer.seek(0)
+        buffer.truncate()
+        if chunk:
+            yield chunk
+    tail = emit(buffer.getvalue())
+    if compressor:
+        tail += compressor.flush()
+    if tail:
+        yield tail
+
+
+def write_export(fileobj, table: str, fmt: str = 'csv', compress: bool = False) -> int:
+    written = 0
+    for chunk in iter_export(table, fmt, compress):
+        fileobj.write(chunk)
+        written += len(chunk)
+    return written
+
+
+def export_filename(table: str, fmt: str, compress: bool) -> str:
+    return f"{table}.{fmt}" + ('.gz' if compress else '')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('table', choices=sorted(EXPORT_COLUMNS))
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--gzip', action='store_true')
+    parser.add_argument('-o', '--output', help='file to write (default: stdout)')
+    parser.add_argument('--db', default=db.DB_PATH)
+    args = parser.parse_args()
+    db.DB_PATH = args.db
+    if args.output:
+        with open(args.output, 'wb') as f:
+            write_export(f, args.table, args.format, args.gzip)
+    else:
+        write_export(sys.stdout.buffer, args.table, args.format, args.gzip)
+
+
+if __name__ == '__main__':
+    main()
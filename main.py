@@ -1,5 +1,8 @@
+import hashlib
+import hmac
 import logging
-import sqlite3
+import threading
+import time
 from functools import wraps
 from telegram import (
     InlineKeyboardMarkup, InlineKeyboardButton, KeyboardButton,
@@ -9,13 +12,35 @@ from telegram.ext import (
     Updater, CommandHandler, CallbackQueryHandler, ConversationHandler,
     MessageHandler, Filters, CallbackContext
 )
-from telegram.error import BadRequest
+from telegram.constants import MAX_MESSAGE_LENGTH
+from telegram.utils.helpers import escape_markdown
 from datetime import datetime
 import os
 from dotenv import load_dotenv
 from flask import Flask, request
 from telegram import Bot
-from telegram.ext import Dispatcher
+from telegram.ext import Dispatcher, JobQueue
+from db import (
+    init_db, update_application_status,
+    get_application_status, get_applicants_page, count_applicants,
+    bulk_update_application_status, search_applicants
+)
+from audit import log_action
+from media_cache import send_cached_photo
+import outbound
+from webhook import (
+    UpdateIngestor, ShardedIngestor, UpdateDeduplicator, OVERLOAD_REJECT,
+    ADMIN_LANE, LANE_CONVERSATION, LANE_NEW, SHED_DUPLICATE, payload_chat_id
+)
+from persistence import SQLitePersistence
+from callbacks import CallbackRouter
+import db
+import metrics
+import referrals
+import relay
+# profiler, retention, stats and export are imported where they are used: they
+# only serve admin commands and background jobs, so they stay off cold start.
+import audit
 
 load_dotenv()
 
@@ -27,11 +52,52 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-DB_PATH = 'applications.db'
-
 # Replace with your admin's numeric chat id (retrieved via /getid command)
 ADMIN_CHAT_ID = int(os.getenv('ADMIN_CHAT_ID'))
 
+BOT_TOKEN = os.getenv('BOT_TOKEN')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+# Telegram echoes this in X-Telegram-Bot-Api-Secret-Token on every webhook
+# call; requests without it are not from Telegram. It is a hex digest of
+# WEBHOOK_SECRET (or of the bot token), since Telegram only accepts
+# [A-Za-z0-9_-] and a configured secret may contain anything.
+WEBHOOK_SECRET_TOKEN = hashlib.sha256(
+    (os.getenv('WEBHOOK_SECRET') or f'webhook:{BOT_TOKEN}').encode()).hexdigest()
+# Seconds between setWebhook attempts, doubling up to the maximum.
+SET_WEBHOOK_RETRY = 1
+SET_WEBHOOK_RETRY_MAX = 60
+PORT = int(os.getenv('PORT', '5000'))
+
+# Update processing pool behind the webhook (see webhook.py)
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '4'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
+WEBHOOK_OVERLOAD = os.getenv('WEBHOOK_OVERLOAD', OVERLOAD_REJECT)
+
+# Multi-process mode: UPDATE_SHARDS worker processes split user chats between
+# them and the admin chat gets one more (see webhook.ShardedIngestor). 0 keeps
+# everything in this process on WEBHOOK_WORKERS threads.
+UPDATE_SHARDS = int(os.getenv('UPDATE_SHARDS', '0'))
+# Callback data of the home menu buttons; taps on them are new-session traffic.
+MENU_CALLBACKS = {'main_menu', 'rent', 'help', 'testimonials', 'referral', 'contact_admin'}
+# Canned answer for new-session updates shed while the bot is overloaded.
+BUSY_TEXT = "We're getting a lot of messages right now. Please try again in a minute."
+
+# Status cache lifetime in user shards, which don't see the admin lane's writes.
+SHARDED_STATUS_CACHE_TTL = 10
+
+# Opt-in SQL profiling (see profiler.py); QUERY_PROFILE=1 to enable
+QUERY_PROFILE = os.getenv('QUERY_PROFILE') == '1'
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '50'))
+
+# Audit log retention (see retention.py)
+ACTION_RETENTION_DAYS = int(os.getenv('ACTION_RETENTION_DAYS', '90'))
+RETENTION_INTERVAL_HOURS = float(os.getenv('RETENTION_INTERVAL_HOURS', '6'))
+
+STATS_DAYS = 7  # Days of activity shown by /stats
+
+EXPORT_SPOOL_BYTES = 1024 * 1024  # /export buffers this much in memory before using disk
+MAX_DOCUMENT_BYTES = 50 * 1024 * 1024  # Bot API upload limit
+
 # ------------------------- CONVERSATION STATES -------------------------
 
 (
@@ -70,149 +136,110 @@ USER_LIST_PAGE = range(18, 19)[0]  # Add this at the end of state definitions
 
 USERS_PER_PAGE = 5  # Number of users to display per page
 
-# ------------------------- DATABASE FUNCTIONS -------------------------
-
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS applications (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    telegram_id INTEGER,
-                    full_name TEXT,
-                    phone TEXT,
-                    linkedin_account TEXT,
-                    password TEXT,
-                    connections TEXT,
-                    weekly_earning REAL,
-                    status TEXT DEFAULT 'pending'
-                )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS referrals (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    telegram_id INTEGER,
-                    referral_code TEXT,
-                    invited_count INTEGER DEFAULT 0
-                )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS conversations (
-                    user_id INTEGER PRIMARY KEY,
-                    admin_id INTEGER,
-                    last_contact DATETIME DEFAULT CURRENT_TIMESTAMP
-                 )''')  
-    c.execute('''CREATE TABLE IF NOT EXISTS actions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    telegram_id INTEGER,
-                    action TEXT,
-                    details TEXT,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                )''')
-    conn.commit()
-    conn.close()
-
-def log_action(telegram_id: int, action: str, details: str = ""):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''INSERT INTO actions (telegram_id, action, details) VALUES (?, ?, ?)''',
-              (telegram_id, action, details))
-    conn.commit()
-    conn.close()
-
-def save_application(data: dict):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''INSERT INTO applications (
-                    telegram_id, full_name, phone, linkedin_account,
-                    password, connections, weekly_earning, status
-                 ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-              (
-                  data.get('telegram_id'),
-                  data.get('full_name'),
-                  data.get('phone'),
-                  data.get('linkedin_account'),
-                  data.get('password'),
-                  data.get('connections'),
-                  data.get('weekly_earning'),
-                  'pending'
-              ))
-    conn.commit()
-    conn.close()
-    
-
-
-# ***********************************************************
-def update_application_status(telegram_id: int, new_status: str):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''
-        UPDATE applications
-        SET status = ?
-        WHERE telegram_id = ?
-        AND id = (
-            SELECT MAX(id)
-            FROM applications
-            WHERE telegram_id = ?
-        )
-    ''', (new_status, telegram_id, telegram_id))
-    conn.commit()
-    conn.close()
-
-def get_application_status(telegram_id: int) -> str:
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''
-        SELECT status
-        FROM applications
-        WHERE telegram_id = ?
-        ORDER BY id DESC
-        LIMIT 1
-    ''', (telegram_id,))
-    result = c.fetchone()
-    conn.close()
-    return result[0] if result else None
-
-
-
-# Add new database function
-def get_all_users():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''
-        SELECT DISTINCT telegram_id, full_name 
-        FROM applications
-        ORDER BY id DESC  -- Newest first (correct SQL comment syntax)
-    ''')
-    users = c.fetchall()
-    conn.close()
-    return users
+BANNER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets", "Linked Banner.jpg")
 
+# Messages relayed between users and the admin chat (see relay.py).
+RELAYED = (Filters.text | Filters.photo | Filters.document) & ~Filters.command
 
+# Status written for each review decision
+REVIEW_STATUSES = {
+    'approve': 'accepted ✅',
+    'reject': 'rejected ❌',
+}
+REVIEW_LABELS = {
+    'approve': "✅ Approved",
+    'reject': "❌ Rejected",
+}
 
+# Inline button actions (see callbacks.py); each is routed to one handler below.
+router = CallbackRouter()
+USERS_PAGE = router.action('u', 'users_page', str, int, int)     # direction, page, cursor
+FIND_PAGE = router.action('f', 'find_page', str, int, int)       # direction, page, cursor
+REVIEW = router.action('r', 'review', str, int)                  # decision, telegram_id
+BULK_TOGGLE = router.action('t', 'bulk_toggle', int)             # telegram_id
+BULK_REVIEW = router.action('b', 'bulk_review', str, str)        # decision, 'page' | 'selected'
+REVIEW_DONE = router.action('d', 'review_done')
+MESSAGE_USER = router.action('m', 'message_user', int)           # telegram_id
+LEADERBOARD = router.action('l', 'leaderboard', int)             # page
 
 # ------------------------- HELPER FUNCTIONS -------------------------
 
+def instrumented(handler):
+    """Records the handler's latency and failures in the /metrics histograms."""
+    @wraps(handler)
+    def wrapper(update, context, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return handler(update, context, *args, **kwargs)
+        except Exception:
+            metrics.HANDLER_ERRORS.inc(handler.__name__)
+            raise
+        finally:
+            metrics.HANDLER_LATENCY.observe(time.perf_counter() - t0, handler.__name__)
+    return wrapper
+
 from telegram import ParseMode
 
+def respond(update: Update, fn, *args, **kwargs):
+    """
+    Queues a Bot API call answering `update` on the send scheduler and returns
+    its Future without waiting, so the worker thread moves on to the next
+    update while the request is in flight. Failures are logged.
+    """
+    future = outbound.submit(update.effective_chat.id, fn, *args, **kwargs)
+    future.add_done_callback(_log_failed_response)
+    return future
+
+
+def answer_query(update: Update, *args, **kwargs):
+    """
+    respond() with the callback query's answer, which stops the button's
+    spinner. It isn't a message, so it skips the chat's send rate limit.
+    """
+    return respond(update, update.callback_query.answer, *args, per_chat=False, **kwargs)
+
+
+def _log_failed_response(future):
+    error = future.exception()
+    if error is not None:
+        logger.error(f"Failed to respond: {error}")
+
+
 def safe_edit_caption(query, text, reply_markup=None):
     """
     Tries to edit either text or caption, always using Markdown parsing,
     so your **bold** and *italic* will render correctly.
     """
     try:
+        chat_id = query.message.chat_id
         if query.message.text:  # If it's a text message
-            query.edit_message_text(
+            future = outbound.submit(
+                chat_id,
+                query.edit_message_text,
                 text=text,
                 reply_markup=reply_markup,
                 parse_mode=ParseMode.MARKDOWN
             )
         elif query.message.caption:  # If it's a media message with a caption
-            query.edit_message_caption(
+            future = outbound.submit(
+                chat_id,
+                query.edit_message_caption,
                 caption=text,
                 reply_markup=reply_markup,
                 parse_mode=ParseMode.MARKDOWN
             )
         else:
-            # fallback or log warning
-            print("⚠️ Message has neither text nor caption.")
+            logger.warning("Message has neither text nor caption.")
+            return
+        future.add_done_callback(_log_failed_edit)
     except Exception as e:
-        print(f"❌ Failed to edit message: {e}")
+        logger.error(f"Failed to edit message: {e}")
+
+
+def _log_failed_edit(future):
+    error = future.exception()
+    if error is not None:
+        logger.error(f"Failed to edit message: {error}")
 
 
 
@@ -220,14 +247,55 @@ def go_home(update: Update, context: CallbackContext) -> int:
     return main_menu(update, context)
 
 # Temporary command to get chat id for admin
+@instrumented
 def get_id(update: Update, context: CallbackContext):
     chat_id = update.effective_chat.id
-    update.message.reply_text(f"Your chat id is: {chat_id}")
+    respond(update, update.message.reply_text, f"Your chat id is: {chat_id}")
 
 # ------------------------- HANDLER FUNCTIONS -------------------------
 
+def credit_invite(context: CallbackContext, invitee_id, code):
+    referrer_id = referrals.credit_referral(invitee_id, code)
+    if referrer_id is None:
+        return
+    log_action(referrer_id, 'referral_credited', f'Invited {invitee_id}')
+    outbound.submit(
+        referrer_id,
+        context.bot.send_message,
+        chat_id=referrer_id,
+        text="🎉 Someone just joined with your referral link!",
+        priority=outbound.BULK
+    )
+
+
+def build_referral_page(context: CallbackContext, telegram_id, page):
+    code, invited = referrals.get_referral(telegram_id)
+    rows, has_next = referrals.get_leaderboard(page)
+    link = f"https://t.me/{context.bot.username}?start={code}"
+    text = (f"*Invite friends with your referral link:*\n{escape_markdown(link)}\n\n"
+            f"Friends invited: {invited}\n\n*🏆 Top referrers*\n")
+    for rank, _, full_name, count in rows:
+        # First names only: the leaderboard is shown to every user.
+        name = (full_name or '').split(' ')[0] or 'Anonymous'
+        text += f"{rank}. {escape_markdown(name)} — {count}\n"
+    if not rows:
+        text += "No invites yet. Be the first!\n"
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("Previous", callback_data=LEADERBOARD.encode(page - 1)))
+    if has_next:
+        navigation.append(InlineKeyboardButton("Next", callback_data=LEADERBOARD.encode(page + 1)))
+    keyboard = [navigation] if navigation else []
+    keyboard.append([InlineKeyboardButton("Back", callback_data="main_menu")])
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+@instrumented
 def start(update: Update, context: CallbackContext) -> int:
     user = update.effective_user
+    if context.args:
+        # Deep link t.me/<bot>?start=<referral code>
+        credit_invite(context, user.id, context.args[0])
     context.user_data['full_name'] = user.first_name
     status = get_application_status(user.id)
     status_text = f"\n\nYour current application status: \n {status.capitalize()}" if status else "\n\nYou have no active applications."
@@ -240,23 +308,26 @@ def start(update: Update, context: CallbackContext) -> int:
         [InlineKeyboardButton("Rent", callback_data="rent"),
          InlineKeyboardButton("Help", callback_data="help")],
         [InlineKeyboardButton("Testimonials", callback_data="testimonials"),
-         InlineKeyboardButton("Referral", callback_data="referral")]
+         InlineKeyboardButton("Referral", callback_data="referral")],
+        [InlineKeyboardButton("Contact admin", callback_data="contact_admin")]
     ]
-    with open("./assets/Linked Banner.jpg", "rb") as banner:
-        photo_message = context.bot.send_photo(
-            chat_id=update.effective_chat.id,
-            photo=banner,
-            caption=caption,
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-    context.user_data['menu_message_id'] = photo_message.message_id
+    respond(
+        update,
+        send_cached_photo,
+        context.bot,
+        update.effective_chat.id,
+        BANNER_PATH,
+        caption=caption,
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
     return HOME
 
 
+@instrumented
 def main_menu(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
-    query.answer()
-    query.delete_message()
+    answer_query(update)
+    respond(update, query.delete_message, per_chat=False)
     user_id = update.effective_user.id
     status = get_application_status(user_id)
     status_text = f"\n\nYour current application status: {status.capitalize()}" if status else "\n\nYou have no active applications."
@@ -269,391 +340,722 @@ def main_menu(update: Update, context: CallbackContext) -> int:
         [InlineKeyboardButton("Rent", callback_data="rent"),
          InlineKeyboardButton("Help", callback_data="help")],
         [InlineKeyboardButton("Testimonials", callback_data="testimonials"),
-         InlineKeyboardButton("Referral", callback_data="referral")]
+         InlineKeyboardButton("Referral", callback_data="referral")],
+        [InlineKeyboardButton("Contact admin", callback_data="contact_admin")]
     ]
-    with open("./assets/Linked Banner.jpg", "rb") as banner:
-        photo_message = context.bot.send_photo(
-            chat_id=update.effective_chat.id,
-            photo=banner,
-            caption=caption,
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-    context.user_data['menu_message_id'] = photo_message.message_id
+    respond(
+        update,
+        send_cached_photo,
+        context.bot,
+        update.effective_chat.id,
+        BANNER_PATH,
+        caption=caption,
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
     return HOME
 # *************************************
 
-def admin_approve_reject(update: Update, context: CallbackContext):
+@router.handles(REVIEW)
+@instrumented
+def admin_approve_reject(update: Update, context: CallbackContext, decision, telegram_id):
     query = update.callback_query
-    query.answer()
-
-    data = query.data
-    action, user_id = data.split('_', 1)
-    user_id = int(user_id)
-
-    if action == 'approve':
-        new_status = 'accepted ✅'
-        status_text = "✅ Approved"
-    elif action == 'reject':
-        new_status = 'rejected ❌'
-        status_text = "❌ Rejected"
-    else:
+    if update.effective_user.id != ADMIN_CHAT_ID:
+        answer_query(update, "You are not authorized to do this.")
+        return
+    answer_query(update)
+    new_status = REVIEW_STATUSES.get(decision)
+    if new_status is None:
         return
 
-    update_application_status(user_id, new_status)
+    update_application_status(telegram_id, new_status)
+    log_action(update.effective_user.id, f'{decision}_user', f'User {telegram_id}')
 
-    try:
-        context.bot.send_message(
-            chat_id=user_id,
-            text=f"Your application has been {new_status}!"
-        )
-    except Exception as e:
-        logger.error(f"Failed to notify user {user_id}: {e}")
+    # Notifications are bulk traffic: queued behind interactive replies and
+    # logged by the scheduler if they ultimately fail.
+    outbound.submit(
+        telegram_id,
+        context.bot.send_message,
+        chat_id=telegram_id,
+        text=f"Your application has been {new_status}!",
+        priority=outbound.BULK
+    )
 
-    try:
-        original_text = query.message.text
-        
-        # Preserve both status and message button
-        new_keyboard = [
-            [
-                InlineKeyboardButton(status_text, callback_data="status"),
-                InlineKeyboardButton("💬 Send Message", callback_data=f"message_{user_id}")
-            ]
+    # Preserve both status and message button
+    new_keyboard = [
+        [
+            InlineKeyboardButton(REVIEW_LABELS[decision], callback_data=REVIEW_DONE.encode()),
+            InlineKeyboardButton("💬 Send Message", callback_data=MESSAGE_USER.encode(telegram_id))
         ]
-        
-        query.edit_message_text(
-            text=original_text,
-            reply_markup=InlineKeyboardMarkup(new_keyboard)
-        )
-    except BadRequest as e:
-        logger.error(f"Failed to edit message: {e}")
+    ]
+    respond(
+        update,
+        query.edit_message_text,
+        text=query.message.text,
+        reply_markup=InlineKeyboardMarkup(new_keyboard)
+    )
+    return USER_LIST_PAGE
 
-    return
 
-def get_users_page(users, page):
-    start = page * USERS_PER_PAGE
-    end = start + USERS_PER_PAGE
-    return users[start:end]
+@router.handles(REVIEW_DONE)
+def review_done(update: Update, context: CallbackContext):
+    answer_query(update, "Already reviewed.")
 
 
-# Add admin message handlers
-def list_users(update: Update, context: CallbackContext, page=0):
+@router.handles(MESSAGE_USER)
+def message_user(update: Update, context: CallbackContext, telegram_id):
     if update.effective_user.id != ADMIN_CHAT_ID:
-        update.message.reply_text("You are not authorized to use this command.")
+        answer_query(update, "You are not authorized to do this.")
         return
-    users = get_all_users()
-    total_pages = (len(users) + USERS_PER_PAGE - 1) // USERS_PER_PAGE
-    start = page * USERS_PER_PAGE
-    end = start + USERS_PER_PAGE
-    page_users = users[start:end]
-    text = f"Users (page {page+1}/{total_pages}):\n"
-    for idx, (telegram_id, full_name) in enumerate(page_users, start=1):
-        text += f"{idx}. {full_name} (ID: {telegram_id})\n"
-    keyboard = []
-    if page > 0:
-        keyboard.append([InlineKeyboardButton("Previous", callback_data=f"users_page_{page-1}")])
-    if end < len(users):
-        keyboard.append([InlineKeyboardButton("Next", callback_data=f"users_page_{page+1}")])
-    for telegram_id, full_name in page_users:
-        keyboard.append([
-            InlineKeyboardButton(f"Approve {full_name}", callback_data=f"approve_{telegram_id}"),
-            InlineKeyboardButton(f"Reject {full_name}", callback_data=f"reject_{telegram_id}")
-        ])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    update.message.reply_text(text, reply_markup=reply_markup)
-    log_action(update.effective_user.id, 'list_users', f'Page {page+1}')
-    return USER_LIST_PAGE
+    answer_query(update)
 
-def handle_user_pagination(update: Update, context: CallbackContext):
-    query = update.callback_query
-    page = int(query.data.split('_')[-1])
-    query.answer()
-    users = get_all_users()
-    total_pages = (len(users) + USERS_PER_PAGE - 1) // USERS_PER_PAGE
-    start = page * USERS_PER_PAGE
-    end = start + USERS_PER_PAGE
-    page_users = users[start:end]
-    text = f"Users (page {page+1}/{total_pages}):\n"
-    for idx, (telegram_id, full_name) in enumerate(page_users, start=1):
-        text += f"{idx}. {full_name} (ID: {telegram_id})\n"
-    keyboard = []
-    if page > 0:
-        keyboard.append([InlineKeyboardButton("Previous", callback_data=f"users_page_{page-1}")])
-    if end < len(users):
-        keyboard.append([InlineKeyboardButton("Next", callback_data=f"users_page_{page+1}")])
-    for telegram_id, full_name in page_users:
-        keyboard.append([
-            InlineKeyboardButton(f"Approve {full_name}", callback_data=f"approve_{telegram_id}"),
-            InlineKeyboardButton(f"Reject {full_name}", callback_data=f"reject_{telegram_id}")
-        ])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    query.edit_message_text(text, reply_markup=reply_markup)
-    log_action(update.effective_user.id, 'paginate_users', f'Page {page+1}')
-    return USER_LIST_PAGE
+    # Replying to the prompt routes like a reply to one of the user's messages.
+    def prompted(future):
+        if not future.exception():
+            relay.routes.open(telegram_id, update.effective_user.id, future.result().message_id)
+    outbound.submit(
+        ADMIN_CHAT_ID,
+        context.bot.send_message,
+        chat_id=ADMIN_CHAT_ID,
+        text=f"{relay.header(telegram_id)}\n\nReply to this message to write to them."
+    ).add_done_callback(prompted)
 
-def admin_approve_reject(update: Update, context: CallbackContext):
+
+@instrumented
+def contact_admin(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
-    data = query.data
-    if data.startswith('approve_'):
-        telegram_id = int(data.split('_')[1])
-        update_application_status(telegram_id, 'approved')
-        log_action(update.effective_user.id, 'approve_user', f'User {telegram_id}')
-        query.answer("User approved.")
-        query.edit_message_text(f"User {telegram_id} approved.")
-    elif data.startswith('reject_'):
-        telegram_id = int(data.split('_')[1])
-        update_application_status(telegram_id, 'rejected')
-        log_action(update.effective_user.id, 'reject_user', f'User {telegram_id}')
-        query.answer("User rejected.")
-        query.edit_message_text(f"User {telegram_id} rejected.")
-    return USER_LIST_PAGE
+    answer_query(update)
+    keyboard = [[InlineKeyboardButton("Back", callback_data="main_menu")]]
+    safe_edit_caption(query, "Send your message here and an admin will reply in this chat.",
+                      InlineKeyboardMarkup(keyboard))
+    return CONTACT_ADMIN
 
-def get_users_page(users, page):
-    start = page * USERS_PER_PAGE
-    end = start + USERS_PER_PAGE
-    return users[start:end]
 
+@instrumented
+def relay_to_admin(update: Update, context: CallbackContext) -> int:
+    """Copies a user's message to the admin chat under a header naming them."""
+    message = update.message
+    user = update.effective_user
+    title = relay.header(user.id, user.full_name)
+    if message.text:
+        future = outbound.submit(ADMIN_CHAT_ID, context.bot.send_message, chat_id=ADMIN_CHAT_ID,
+                                 text=f"{title}\n\n{message.text}")
+    else:
+        future = outbound.submit(ADMIN_CHAT_ID, context.bot.copy_message, chat_id=ADMIN_CHAT_ID,
+                                 from_chat_id=message.chat_id, message_id=message.message_id,
+                                 caption=f"{title}\n\n{message.caption or ''}".rstrip())
 
-# Add admin message handlers
-def list_users(update: Update, context: CallbackContext, page=0):
-    if update.effective_user.id != ADMIN_CHAT_ID:
-        update.message.reply_text("You are not authorized to use this command.")
+    def relayed(future):
+        if future.exception():
+            respond(update, message.reply_text, "Sorry, your message couldn't be delivered. Please try again.")
+        else:
+            relay.routes.record(user.id, ADMIN_CHAT_ID, future.result().message_id)
+    future.add_done_callback(relayed)
+    log_action(user.id, 'relay_to_admin', f'{len(message.text or message.caption or "")} chars')
+    return CONTACT_ADMIN
+
+
+@instrumented
+def relay_to_user(update: Update, context: CallbackContext):
+    """Sends an admin's reply to the user whose relayed message it answers."""
+    message = update.message
+    user_id = relay.routes.user_for(message.reply_to_message)
+    if user_id is None:
+        respond(update, message.reply_text, "That message isn't from a user. Use /send <user_id> <message>.")
         return
-    users = get_all_users()
-    total_pages = (len(users) + USERS_PER_PAGE - 1) // USERS_PER_PAGE
-    start = page * USERS_PER_PAGE
-    end = start + USERS_PER_PAGE
-    page_users = users[start:end]
-    text = f"Users (page {page+1}/{total_pages}):\n"
-    for idx, (telegram_id, full_name) in enumerate(page_users, start=1):
-        text += f"{idx}. {full_name} (ID: {telegram_id})\n"
-    keyboard = []
-    if page > 0:
-        keyboard.append([InlineKeyboardButton("Previous", callback_data=f"users_page_{page-1}")])
-    if end < len(users):
-        keyboard.append([InlineKeyboardButton("Next", callback_data=f"users_page_{page+1}")])
-    for telegram_id, full_name in page_users:
-        keyboard.append([
-            InlineKeyboardButton(f"Approve {full_name}", callback_data=f"approve_{telegram_id}"),
-            InlineKeyboardButton(f"Reject {full_name}", callback_data=f"reject_{telegram_id}")
-        ])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    update.message.reply_text(text, reply_markup=reply_markup)
-    log_action(update.effective_user.id, 'list_users', f'Page {page+1}')
-    return USER_LIST_PAGE
 
-def handle_user_pagination(update: Update, context: CallbackContext):
+    def report(future):
+        error = future.exception()
+        if error:
+            respond(update, message.reply_text, f"Failed to send message: {error}")
+    outbound.submit(user_id, context.bot.copy_message, chat_id=user_id, from_chat_id=message.chat_id,
+                    message_id=message.message_id).add_done_callback(report)
+    relay.routes.open(user_id, update.effective_user.id)
+    log_action(update.effective_user.id, 'relay_to_user', f'To {user_id}')
+
+
+@router.unknown
+def expired_button(update: Update, context: CallbackContext):
+    answer_query(update, "This button has expired.")
+
+@instrumented
+def show_referral(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    answer_query(update)
+    text, reply_markup = build_referral_page(context, update.effective_user.id, 0)
+    safe_edit_caption(query, text, reply_markup)
+    return HOME
+
+
+@router.handles(LEADERBOARD)
+@instrumented
+def leaderboard_page(update: Update, context: CallbackContext, page):
     query = update.callback_query
-    page = int(query.data.split('_')[-1])
-    query.answer()
-    users = get_all_users()
-    total_pages = (len(users) + USERS_PER_PAGE - 1) // USERS_PER_PAGE
-    start = page * USERS_PER_PAGE
-    end = start + USERS_PER_PAGE
-    page_users = users[start:end]
+    answer_query(update)
+    text, reply_markup = build_referral_page(context, update.effective_user.id, page)
+    safe_edit_caption(query, text, reply_markup)
+
+
+def get_users_page(before_id=None, after_id=None):
+    """Fetches one page of applicants using the keyset cursor from the callback data."""
+    return get_applicants_page(before_id=before_id, after_id=after_id, limit=USERS_PER_PAGE)
+
+
+def review_buttons(telegram_id, full_name):
+    return [
+        InlineKeyboardButton(f"Approve {full_name}", callback_data=REVIEW.encode('approve', telegram_id)),
+        InlineKeyboardButton(f"Reject {full_name}", callback_data=REVIEW.encode('reject', telegram_id))
+    ]
+
+
+def build_users_page(rows, page, has_next, selected=()):
+    total_pages = max((count_applicants() + USERS_PER_PAGE - 1) // USERS_PER_PAGE, 1)
     text = f"Users (page {page+1}/{total_pages}):\n"
-    for idx, (telegram_id, full_name) in enumerate(page_users, start=1):
+    for idx, (_, telegram_id, full_name) in enumerate(rows, start=1):
         text += f"{idx}. {full_name} (ID: {telegram_id})\n"
+    if selected:
+        text += f"\n{len(selected)} selected for bulk review."
     keyboard = []
-    if page > 0:
-        keyboard.append([InlineKeyboardButton("Previous", callback_data=f"users_page_{page-1}")])
-    if end < len(users):
-        keyboard.append([InlineKeyboardButton("Next", callback_data=f"users_page_{page+1}")])
-    for telegram_id, full_name in page_users:
+    # Cursors carry the boundary application id, so the next query seeks
+    # straight to it instead of skipping page * USERS_PER_PAGE rows.
+    if page > 0 and rows:
+        keyboard.append([InlineKeyboardButton("Previous", callback_data=USERS_PAGE.encode('prev', page - 1, rows[0][0]))])
+    if has_next and rows:
+        keyboard.append([InlineKeyboardButton("Next", callback_data=USERS_PAGE.encode('next', page + 1, rows[-1][0]))])
+    for _, telegram_id, full_name in rows:
+        mark = "☑" if telegram_id in selected else "☐"
+        keyboard.append([InlineKeyboardButton(mark, callback_data=BULK_TOGGLE.encode(telegram_id))]
+                        + review_buttons(telegram_id, full_name))
+    if rows:
         keyboard.append([
-            InlineKeyboardButton(f"Approve {full_name}", callback_data=f"approve_{telegram_id}"),
-            InlineKeyboardButton(f"Reject {full_name}", callback_data=f"reject_{telegram_id}")
+            InlineKeyboardButton("Approve page", callback_data=BULK_REVIEW.encode('approve', 'page')),
+            InlineKeyboardButton("Reject page", callback_data=BULK_REVIEW.encode('reject', 'page'))
         ])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    query.edit_message_text(text, reply_markup=reply_markup)
-    log_action(update.effective_user.id, 'paginate_users', f'Page {page+1}')
-    return USER_LIST_PAGE
+    if selected:
+        keyboard.append([
+            InlineKeyboardButton("Approve selected", callback_data=BULK_REVIEW.encode('approve', 'selected')),
+            InlineKeyboardButton("Reject selected", callback_data=BULK_REVIEW.encode('reject', 'selected'))
+        ])
+    return text, InlineKeyboardMarkup(keyboard)
 
-def admin_approve_reject(update: Update, context: CallbackContext):
-    query = update.callback_query
-    data = query.data
-    if data.startswith('approve_'):
-        telegram_id = int(data.split('_')[1])
-        update_application_status(telegram_id, 'approved')
-        log_action(update.effective_user.id, 'approve_user', f'User {telegram_id}')
-        query.answer("User approved.")
-        query.edit_message_text(f"User {telegram_id} approved.")
-    elif data.startswith('reject_'):
-        telegram_id = int(data.split('_')[1])
-        update_application_status(telegram_id, 'rejected')
-        log_action(update.effective_user.id, 'reject_user', f'User {telegram_id}')
-        query.answer("User rejected.")
-        query.edit_message_text(f"User {telegram_id} rejected.")
-    return USER_LIST_PAGE
 
-def get_users_page(users, page):
-    start = page * USERS_PER_PAGE
-    end = start + USERS_PER_PAGE
-    return users[start:end]
+def show_users_page(context: CallbackContext, rows, page, has_next):
+    # Kept so bulk review can redraw the page without another query.
+    context.user_data['users_page'] = (rows, page, has_next)
+    return build_users_page(rows, page, has_next, context.user_data.get('bulk_selected', set()))
 
 
 # Add admin message handlers
-def list_users(update: Update, context: CallbackContext, page=0):
+@instrumented
+def list_users(update: Update, context: CallbackContext):
     if update.effective_user.id != ADMIN_CHAT_ID:
-        update.message.reply_text("You are not authorized to use this command.")
+        respond(update, update.message.reply_text, "You are not authorized to use this command.")
         return
-    users = get_all_users()
-    total_pages = (len(users) + USERS_PER_PAGE - 1) // USERS_PER_PAGE
-    start = page * USERS_PER_PAGE
-    end = start + USERS_PER_PAGE
-    page_users = users[start:end]
-    text = f"Users (page {page+1}/{total_pages}):\n"
-    for idx, (telegram_id, full_name) in enumerate(page_users, start=1):
-        text += f"{idx}. {full_name} (ID: {telegram_id})\n"
-    keyboard = []
-    if page > 0:
-        keyboard.append([InlineKeyboardButton("Previous", callback_data=f"users_page_{page-1}")])
-    if end < len(users):
-        keyboard.append([InlineKeyboardButton("Next", callback_data=f"users_page_{page+1}")])
-    for telegram_id, full_name in page_users:
-        keyboard.append([
-            InlineKeyboardButton(f"Approve {full_name}", callback_data=f"approve_{telegram_id}"),
-            InlineKeyboardButton(f"Reject {full_name}", callback_data=f"reject_{telegram_id}")
-        ])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    update.message.reply_text(text, reply_markup=reply_markup)
-    log_action(update.effective_user.id, 'list_users', f'Page {page+1}')
+    rows, has_next = get_users_page()
+    text, reply_markup = show_users_page(context, rows, 0, has_next)
+    respond(update, update.message.reply_text, text, reply_markup=reply_markup)
+    log_action(update.effective_user.id, 'list_users', 'Page 1')
     return USER_LIST_PAGE
 
-def handle_user_pagination(update: Update, context: CallbackContext):
+@router.handles(USERS_PAGE)
+@instrumented
+def handle_user_pagination(update: Update, context: CallbackContext, direction, page, cursor):
     query = update.callback_query
-    page = int(query.data.split('_')[-1])
-    query.answer()
-    users = get_all_users()
-    total_pages = (len(users) + USERS_PER_PAGE - 1) // USERS_PER_PAGE
-    start = page * USERS_PER_PAGE
-    end = start + USERS_PER_PAGE
-    page_users = users[start:end]
-    text = f"Users (page {page+1}/{total_pages}):\n"
-    for idx, (telegram_id, full_name) in enumerate(page_users, start=1):
-        text += f"{idx}. {full_name} (ID: {telegram_id})\n"
-    keyboard = []
-    if page > 0:
-        keyboard.append([InlineKeyboardButton("Previous", callback_data=f"users_page_{page-1}")])
-    if end < len(users):
-        keyboard.append([InlineKeyboardButton("Next", callback_data=f"users_page_{page+1}")])
-    for telegram_id, full_name in page_users:
-        keyboard.append([
-            InlineKeyboardButton(f"Approve {full_name}", callback_data=f"approve_{telegram_id}"),
-            InlineKeyboardButton(f"Reject {full_name}", callback_data=f"reject_{telegram_id}")
-        ])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    query.edit_message_text(text, reply_markup=reply_markup)
+    if update.effective_user.id != ADMIN_CHAT_ID:
+        answer_query(update, "You are not authorized to do this.")
+        return
+    answer_query(update)
+    if direction == 'next':
+        rows, has_next = get_users_page(before_id=cursor)
+    else:
+        rows, has_previous = get_users_page(after_id=cursor)
+        # Walking backwards always leaves a page after this one.
+        has_next = True
+        if not has_previous:
+            page = 0
+    text, reply_markup = show_users_page(context, rows, page, has_next)
+    respond(update, query.edit_message_text, text, reply_markup=reply_markup)
     log_action(update.effective_user.id, 'paginate_users', f'Page {page+1}')
     return USER_LIST_PAGE
 
-def admin_approve_reject(update: Update, context: CallbackContext):
-    query = update.callback_query
-    data = query.data
-    if data.startswith('approve_'):
-        telegram_id = int(data.split('_')[1])
-        update_application_status(telegram_id, 'approved')
-        log_action(update.effective_user.id, 'approve_user', f'User {telegram_id}')
-        query.answer("User approved.")
-        query.edit_message_text(f"User {telegram_id} approved.")
-    elif data.startswith('reject_'):
-        telegram_id = int(data.split('_')[1])
-        update_application_status(telegram_id, 'rejected')
-        log_action(update.effective_user.id, 'reject_user', f'User {telegram_id}')
-        query.answer("User rejected.")
-        query.edit_message_text(f"User {telegram_id} rejected.")
-    return USER_LIST_PAGE
+def build_search_page(search, rows, page, has_next):
+    if not rows:
+        return f"No applicants match \"{search}\".", None
+    text = f"Results for \"{search}\" (page {page+1}):\n"
+    for idx, (_, telegram_id, full_name) in enumerate(rows, start=1):
+        text += f"{idx}. {full_name} (ID: {telegram_id})\n"
+    keyboard = []
+    if page > 0:
+        keyboard.append([InlineKeyboardButton("Previous", callback_data=FIND_PAGE.encode('prev', page - 1, rows[0][0]))])
+    if has_next:
+        keyboard.append([InlineKeyboardButton("Next", callback_data=FIND_PAGE.encode('next', page + 1, rows[-1][0]))])
+    for _, telegram_id, full_name in rows:
+        keyboard.append(review_buttons(telegram_id, full_name))
+    return text, InlineKeyboardMarkup(keyboard)
 
-def get_users_page(users, page):
-    start = page * USERS_PER_PAGE
-    end = start + USERS_PER_PAGE
-    return users[start:end]
 
+@instrumented
+def find_users(update: Update, context: CallbackContext):
+    if update.effective_user.id != ADMIN_CHAT_ID:
+        respond(update, update.message.reply_text, "You are not authorized to use this command.")
+        return
+    search = ' '.join(context.args or []).strip()
+    if not search:
+        respond(update, update.message.reply_text, "Usage: /find <name, LinkedIn or user id>")
+        return
+    # Callback data can't hold arbitrary text, so paging reads it back from here.
+    context.user_data['find_query'] = search
+    rows, has_next = search_applicants(search, limit=USERS_PER_PAGE)
+    text, reply_markup = build_search_page(search, rows, 0, has_next)
+    respond(update, update.message.reply_text, text, reply_markup=reply_markup)
+    log_action(update.effective_user.id, 'find_users', search)
+    return USER_LIST_PAGE
 
-# Add admin message handlers
-def list_users(update: Update, context: CallbackContext, page=0):
+@router.handles(FIND_PAGE)
+@instrumented
+def handle_find_pagination(update: Update, context: CallbackContext, direction, page, cursor):
+    query = update.callback_query
     if update.effective_user.id != ADMIN_CHAT_ID:
-        update.message.reply_text("You are not authorized to use this command.")
+        answer_query(update, "You are not authorized to do this.")
         return
-    users = get_all_users()
-    total_pages = (len(users) + USERS_PER_PAGE - 1) // USERS_PER_PAGE
-    start = page * USERS_PER_PAGE
-    end = start + USERS_PER_PAGE
-    page_users = users[start:end]
-    text = f"Users (page {page+1}/{total_pages}):\n"
-    for idx, (telegram_id, full_name) in enumerate(page_users, start=1):
-        text += f"{idx}. {full_name} (ID: {telegram_id})\n"
-    keyboard = []
-    if page > 0:
-        keyboard.append([InlineKeyboardButton("Previous", callback_data=f"users_page_{page-1}")])
-    if end < len(users):
-        keyboard.append([InlineKeyboardButton("Next", callback_data=f"users_page_{page+1}")])
-    for telegram_id, full_name in page_users:
-        keyboard.append([
-            InlineKeyboardButton(f"Approve {full_name}", callback_data=f"approve_{telegram_id}"),
-            InlineKeyboardButton(f"Reject {full_name}", callback_data=f"reject_{telegram_id}")
-        ])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    update.message.reply_text(text, reply_markup=reply_markup)
-    log_action(update.effective_user.id, 'list_users', f'Page {page+1}')
+    answer_query(update)
+    search = context.user_data.get('find_query')
+    if not search:
+        respond(update, query.edit_message_text, "Search expired, run /find again.")
+        return
+    if direction == 'next':
+        rows, has_next = search_applicants(search, before_id=cursor, limit=USERS_PER_PAGE)
+    else:
+        rows, has_previous = search_applicants(search, after_id=cursor, limit=USERS_PER_PAGE)
+        has_next = True
+        if not has_previous:
+            page = 0
+    text, reply_markup = build_search_page(search, rows, page, has_next)
+    respond(update, query.edit_message_text, text, reply_markup=reply_markup)
     return USER_LIST_PAGE
 
-def handle_user_pagination(update: Update, context: CallbackContext):
+@router.handles(BULK_TOGGLE)
+@instrumented
+def bulk_toggle(update: Update, context: CallbackContext, telegram_id):
     query = update.callback_query
-    page = int(query.data.split('_')[-1])
-    query.answer()
-    users = get_all_users()
-    total_pages = (len(users) + USERS_PER_PAGE - 1) // USERS_PER_PAGE
-    start = page * USERS_PER_PAGE
-    end = start + USERS_PER_PAGE
-    page_users = users[start:end]
-    text = f"Users (page {page+1}/{total_pages}):\n"
-    for idx, (telegram_id, full_name) in enumerate(page_users, start=1):
-        text += f"{idx}. {full_name} (ID: {telegram_id})\n"
-    keyboard = []
-    if page > 0:
-        keyboard.append([InlineKeyboardButton("Previous", callback_data=f"users_page_{page-1}")])
-    if end < len(users):
-        keyboard.append([InlineKeyboardButton("Next", callback_data=f"users_page_{page+1}")])
-    for telegram_id, full_name in page_users:
-        keyboard.append([
-            InlineKeyboardButton(f"Approve {full_name}", callback_data=f"approve_{telegram_id}"),
-            InlineKeyboardButton(f"Reject {full_name}", callback_data=f"reject_{telegram_id}")
-        ])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    query.edit_message_text(text, reply_markup=reply_markup)
-    log_action(update.effective_user.id, 'paginate_users', f'Page {page+1}')
+    if update.effective_user.id != ADMIN_CHAT_ID:
+        answer_query(update, "You are not authorized to do this.")
+        return
+    selected = context.user_data.setdefault('bulk_selected', set())
+    rows, page, has_next = context.user_data.get('users_page', ([], 0, False))
+    selected.symmetric_difference_update({telegram_id})
+    answer_query(update)
+    text, reply_markup = build_users_page(rows, page, has_next, selected)
+    respond(update, query.edit_message_text, text, reply_markup=reply_markup)
     return USER_LIST_PAGE
 
-def admin_approve_reject(update: Update, context: CallbackContext):
+@router.handles(BULK_REVIEW)
+@instrumented
+def bulk_review(update: Update, context: CallbackContext, action, target):
     query = update.callback_query
-    data = query.data
-    if data.startswith('approve_'):
-        telegram_id = int(data.split('_')[1])
-        update_application_status(telegram_id, 'approved')
-        log_action(update.effective_user.id, 'approve_user', f'User {telegram_id}')
-        query.answer("User approved.")
-        query.edit_message_text(f"User {telegram_id} approved.")
-    elif data.startswith('reject_'):
-        telegram_id = int(data.split('_')[1])
-        update_application_status(telegram_id, 'rejected')
-        log_action(update.effective_user.id, 'reject_user', f'User {telegram_id}')
-        query.answer("User rejected.")
-        query.edit_message_text(f"User {telegram_id} rejected.")
+    if update.effective_user.id != ADMIN_CHAT_ID:
+        answer_query(update, "You are not authorized to do this.")
+        return
+    selected = context.user_data.setdefault('bulk_selected', set())
+    rows, page, has_next = context.user_data.get('users_page', ([], 0, False))
+    new_status = REVIEW_STATUSES.get(action)
+    if new_status is None:
+        answer_query(update)
+        return
+
+    if target == 'page':
+        telegram_ids = [telegram_id for _, telegram_id, _ in rows]
+    else:
+        telegram_ids = sorted(selected)
+    updated = bulk_update_application_status(telegram_ids, new_status)
+    selected.difference_update(telegram_ids)
+
+    for telegram_id in updated:
+        log_action(update.effective_user.id, f'bulk_{action}_user', f'User {telegram_id}')
+        outbound.submit(
+            telegram_id,
+            context.bot.send_message,
+            chat_id=telegram_id,
+            text=f"Your application has been {new_status}!",
+            priority=outbound.BULK
+        )
+
+    answer_query(update, f"{len(updated)} application(s) {new_status}.")
+    text, reply_markup = build_users_page(rows, page, has_next, selected)
+    respond(update, query.edit_message_text, f"{len(updated)} application(s) {new_status}.\n\n" + text,
+            reply_markup=reply_markup)
     return USER_LIST_PAGE
 
+@instrumented
 def send_user_message(update: Update, context: CallbackContext):
     if update.effective_user.id != ADMIN_CHAT_ID:
-        update.message.reply_text("You are not authorized to use this command.")
+        respond(update, update.message.reply_text, "You are not authorized to use this command.")
         return
     try:
         args = context.args
         if len(args) < 2:
-            update.message.reply_text("Usage: /send <user_id> <message>")
+            respond(update, update.message.reply_text, "Usage: /send <user_id> <message>")
             return
         user_id = int(args[0])
         message = ' '.join(args[1:])
-        context.bot.send_message(chat_id=user_id, text=message)
-        log_action(update.effective_user.id, 'send_message', f'To {user_id}: {message}')
-        update.message.reply_text(f"Message sent to {user_id}.")
+        def report(future):
+            error = future.exception()
+            respond(update, update.message.reply_text,
+                    f"Failed to send message: {error}" if error else f"Message sent to {user_id}.")
+        outbound.submit(user_id, context.bot.send_message, chat_id=user_id, text=message).add_done_callback(report)
+        # Their answers are relayed back to the admin chat.
+        relay.routes.open(user_id, update.effective_user.id)
+        log_action(update.effective_user.id, 'send_message', f'To {user_id}, {len(message)} chars')
     except Exception as e:
-        update.message.reply_text(f"Failed to send message: {e}")
\ No newline at end of file
+        respond(update, update.message.reply_text, f"Failed to send message: {e}")
+
+@instrumented
+def query_report(update: Update, context: CallbackContext):
+    if update.effective_user.id != ADMIN_CHAT_ID:
+        respond(update, update.message.reply_text, "You are not authorized to use this command.")
+        return
+    if not QUERY_PROFILE:
+        respond(update, update.message.reply_text, "Query profiling is off. Set QUERY_PROFILE=1 to enable it.")
+        return
+    from profiler import profiler
+    args = context.args or []
+    if args and args[0] == 'reset':
+        profiler.reset()
+        respond(update, update.message.reply_text, "Query profile cleared.")
+        return
+    top_n = int(args[0]) if args and args[0].isdigit() else 10
+    report = profiler.report(top_n)
+    respond(update, update.message.reply_text,
+            f"Top {top_n} queries by total time:\n\n{report}"[:MAX_MESSAGE_LENGTH])
+
+@instrumented
+def show_stats(update: Update, context: CallbackContext):
+    if update.effective_user.id != ADMIN_CHAT_ID:
+        respond(update, update.message.reply_text, "You are not authorized to use this command.")
+        return
+    from stats import get_application_stats, get_daily_actions
+    summary = get_application_stats()
+    lines = [f"*Applicants:* {summary['total']}"]
+    for status, (count, _) in sorted(summary['by_status'].items(), key=lambda item: -item[1][0]):
+        lines.append(f"  {escape_markdown(status.capitalize())}: {count}")
+    lines.append(f"\n*Projected weekly payout:* ${summary['weekly_payout']:,.2f}")
+    days = {}
+    for day, action, count in get_daily_actions(STATS_DAYS):
+        # Action names like list_users would otherwise open italics.
+        days.setdefault(day, []).append(f"{escape_markdown(action)} {count}")
+    if days:
+        lines.append(f"\n*Activity (last {STATS_DAYS} days):*")
+        for day, actions in days.items():
+            lines.append(f"  {day}: {', '.join(actions)}")
+    # Drops whole lines to fit, since cutting one could split a Markdown entity.
+    text = ''
+    for line in lines:
+        if len(text) + len(line) + 1 > MAX_MESSAGE_LENGTH:
+            break
+        text += line + '\n'
+    respond(update, update.message.reply_text, text, parse_mode=ParseMode.MARKDOWN)
+    log_action(update.effective_user.id, 'stats')
+
+@instrumented
+def export_data(update: Update, context: CallbackContext):
+    if update.effective_user.id != ADMIN_CHAT_ID:
+        respond(update, update.message.reply_text, "You are not authorized to use this command.")
+        return
+    args = [arg.lower() for arg in context.args or []]
+    table = args[0] if args else 'applications'
+    fmt = args[1] if len(args) > 1 else 'csv'
+    compress = 'gz' in args[2:] or 'gzip' in args[2:]
+    import export
+    import tempfile
+    if table not in export.EXPORT_COLUMNS or fmt not in export.FORMATS:
+        respond(update, update.message.reply_text, "Usage: /export <applications|actions> [csv|jsonl] [gz]")
+        return
+    chat_id = update.effective_chat.id
+    # Spills to disk past EXPORT_SPOOL_BYTES so a large export never sits in
+    # memory. It is written on the database's background thread and closed
+    # once the upload is done, so no update worker waits on either.
+    f = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+
+    def uploaded(future):
+        f.close()
+        error = future.exception()
+        if error is not None:
+            respond(update, update.message.reply_text, f"Failed to send the export: {error}")
+
+    def written(future):
+        error = future.exception()
+        if error is not None:
+            f.close()
+            respond(update, update.message.reply_text, f"Export failed: {error}")
+            return
+        size = future.result()
+        if size > MAX_DOCUMENT_BYTES:
+            f.close()
+            respond(update, update.message.reply_text,
+                    f"The export is {size // (1024 * 1024)} MB, above Telegram's upload limit. "
+                    "Try gz, or use export.py on the server.")
+            return
+        f.seek(0)
+        outbound.submit(
+            chat_id,
+            context.bot.send_document,
+            chat_id=chat_id,
+            document=f,
+            filename=export.export_filename(table, fmt, compress)
+        ).add_done_callback(uploaded)
+
+    db.run_in_background(export.write_export, f, table, fmt, compress).add_done_callback(written)
+    log_action(update.effective_user.id, 'export', f'{table} {fmt}{" gz" if compress else ""}')
+
+# ------------------------- APPLICATION SETUP -------------------------
+
+def build_dispatcher(bot: Bot, persistence=None, job_queue=None) -> Dispatcher:
+    # workers=0: updates are processed on the UpdateIngestor's threads.
+    dispatcher = Dispatcher(bot, None, workers=0, use_context=True, persistence=persistence,
+                            job_queue=job_queue)
+    if job_queue is not None:
+        job_queue.set_dispatcher(dispatcher)
+    conversation = ConversationHandler(
+        name='main',
+        persistent=persistence is not None,
+        entry_points=[CommandHandler('start', start)],
+        states={
+            HOME: [
+                CallbackQueryHandler(main_menu, pattern='^main_menu$'),
+                CallbackQueryHandler(show_referral, pattern='^referral$'),
+                CallbackQueryHandler(contact_admin, pattern='^contact_admin$'),
+            ],
+            CONTACT_ADMIN: [
+                CallbackQueryHandler(main_menu, pattern='^main_menu$'),
+                MessageHandler(RELAYED & ~Filters.chat(ADMIN_CHAT_ID), relay_to_admin),
+            ],
+        },
+        fallbacks=[CommandHandler('start', start)],
+    )
+    # Admin replies to relayed messages, ahead of the conversation.
+    dispatcher.add_handler(MessageHandler(Filters.chat(ADMIN_CHAT_ID) & Filters.reply & RELAYED, relay_to_user))
+    dispatcher.add_handler(conversation)
+    # Users an admin has been talking to keep being relayed outside CONTACT_ADMIN.
+    dispatcher.add_handler(MessageHandler(
+        RELAYED & Filters.chat_type.private & ~Filters.chat(ADMIN_CHAT_ID) & relay.OpenConversation(),
+        relay_to_admin
+    ))
+    dispatcher.add_handler(CommandHandler('getid', get_id))
+    dispatcher.add_handler(CommandHandler('users', list_users))
+    dispatcher.add_handler(CommandHandler('send', send_user_message))
+    dispatcher.add_handler(CommandHandler('queries', query_report))
+    dispatcher.add_handler(CommandHandler('stats', show_stats))
+    dispatcher.add_handler(CommandHandler('find', find_users))
+    dispatcher.add_handler(CommandHandler('export', export_data))
+    unrouted = router.unrouted()
+    if unrouted:
+        raise RuntimeError(f"Callback actions without a handler: {', '.join(a.name for a in unrouted)}")
+    # Every other button press: decoded and routed by the callback registry.
+    dispatcher.add_handler(CallbackQueryHandler(router.dispatch))
+    return dispatcher
+
+
+app = Flask(__name__)
+bot = None
+ingestor = None
+dedup = None
+
+
+@app.route('/webhook', methods=['POST'])
+def webhook():
+    # Admin checks trust the sender in the payload, so only Telegram may post here.
+    secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET_TOKEN.encode()):
+        return 'forbidden', 403
+    payload = request.get_json(force=True, silent=True)
+    update_id = payload.get('update_id') if isinstance(payload, dict) else None
+    if not isinstance(update_id, int) or isinstance(update_id, bool):
+        return 'bad request', 400
+    # Telegram redelivers updates it isn't sure we got; acknowledge those
+    # without running their handlers a second time.
+    if not dedup.claim(update_id):
+        return 'ok', 200
+    status = ingestor.submit(payload)
+    if status != 200:
+        dedup.release(update_id)
+        return 'overloaded', status
+    return 'ok', 200
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    # With UPDATE_SHARDS the handlers run in worker processes, which report their own.
+    remote = ingestor.scrape() if isinstance(ingestor, ShardedIngestor) else ()
+    return metrics.render(remote), 200, {'Content-Type': metrics.CONTENT_TYPE}
+
+
+@app.route('/webhook/stats', methods=['GET'])
+def webhook_stats():
+    return dict(ingestor.stats(), dedup=dedup.stats())
+
+
+def register_metrics():
+    """Gauges for the process that handles updates: its caches, queues and SQLite timings."""
+    db.query_observers.append(metrics.observe_query)
+    metrics.gauge('cache_hit_ratio', 'Hit ratio of in-process caches.',
+                  lambda: {('status',): db.status_cache.stats()['hit_ratio']}, ['cache'])
+    metrics.gauge('audit_log_queue_depth', 'Audit rows waiting to be written.',
+                  lambda: {(): audit.writer.stats()['queue_depth']})
+    metrics.gauge('audit_log_dropped_rows', 'Audit rows dropped because the queue was full.',
+                  lambda: {(): audit.writer.dropped})
+    metrics.gauge('outbound_pending', 'Bot API calls waiting in the send scheduler.',
+                  lambda: {(): outbound.scheduler.stats()['pending']})
+
+
+def register_webhook_metrics():
+    """Gauges for the process serving the webhook."""
+    metrics.gauge('webhook_duplicate_updates', 'Redelivered webhook updates that were dropped.',
+                  lambda: {(): dedup.duplicates} if dedup else {})
+    metrics.gauge('update_queue_depth', 'Webhook updates waiting for a worker.',
+                  lambda: {(): ingestor.stats()['queue_depth']} if ingestor else {})
+    metrics.gauge('webhook_shed_updates', 'Updates answered cheaply instead of being processed.',
+                  lambda: dict(getattr(ingestor, 'shed_counts', {})), ['lane', 'reason'])
+
+
+def classify_update(payload):
+    """Update lane and coalescing key for UpdateIngestor, from the raw JSON."""
+    chat_id = payload_chat_id(payload)
+    if chat_id == ADMIN_CHAT_ID:
+        return ADMIN_LANE, None
+    message = payload.get('message')
+    if message and message.get('text', '').startswith('/start'):
+        return LANE_NEW, (chat_id, '/start')
+    query = payload.get('callback_query')
+    if query and query.get('data') in MENU_CALLBACKS:
+        return LANE_NEW, (chat_id, query['data'])
+    return LANE_CONVERSATION, None
+
+
+def shed_update(payload, reason):
+    """
+    Cheap answer for a shed update, with no handler or database work. A repeated
+    tap only needs its spinner stopped, as the first tap is still queued.
+    """
+    chat_id = payload_chat_id(payload)
+    query = payload.get('callback_query')
+    if reason == SHED_DUPLICATE:
+        if query:
+            outbound.submit(chat_id, bot.answer_callback_query, query['id'], per_chat=False)
+    elif query:
+        outbound.submit(chat_id, bot.answer_callback_query, query['id'], text=BUSY_TEXT,
+                        per_chat=False)
+    else:
+        outbound.submit(chat_id, bot.send_message, chat_id=chat_id, text=BUSY_TEXT,
+                        priority=outbound.BULK)
+
+
+def setup_worker(lane: str, lanes: int):
+    """
+    Builds the bot, dispatcher and background services for one update lane
+    and returns (process, teardown), process taking a webhook JSON payload.
+    Runs in this process when UPDATE_SHARDS is 0, otherwise once inside each
+    worker process. Only the admin lane runs the JobQueue.
+    """
+    global bot
+    if QUERY_PROFILE:
+        from profiler import profiler
+        profiler.slow_ms = SLOW_QUERY_MS
+        profiler.install()
+    if lanes > 1:
+        # Telegram's global send limit is per bot, so the lanes split it.
+        outbound.scheduler = outbound.SendScheduler(
+            global_rate=outbound.GLOBAL_RATE / lanes,
+            global_burst=max(outbound.GLOBAL_BURST / lanes, 1),
+        )
+        if lane != ADMIN_LANE:
+            db.status_cache.ttl = SHARDED_STATUS_CACHE_TTL
+    bot = metrics.InstrumentedBot(BOT_TOKEN)
+    register_metrics()
+    persistence = SQLitePersistence(store_chat_data=False, store_bot_data=False)
+    job_queue = None
+    if lane == ADMIN_LANE:
+        import retention
+        job_queue = JobQueue()
+    dispatcher = build_dispatcher(bot, persistence, job_queue)
+    relay.routes.load(shared=lanes > 1)
+    if job_queue is not None:
+        job_queue.run_repeating(
+            retention.retention_job,
+            interval=RETENTION_INTERVAL_HOURS * 3600,
+            first=300,
+            context=ACTION_RETENTION_DAYS,
+            name='action_retention',
+        )
+        job_queue.start()
+
+    def process(payload):
+        dispatcher.process_update(Update.de_json(payload, bot))
+
+    def teardown():
+        if job_queue is not None:
+            job_queue.stop()
+        outbound.scheduler.stop()
+        relay.routes.close()
+        persistence.close()
+
+    return process, teardown
+
+
+def register_webhook():
+    """
+    Points Telegram at WEBHOOK_URL with the secret token, retrying until it
+    succeeds: until then Telegram sends the old token, or nothing, and every
+    update is rejected.
+    """
+    delay = SET_WEBHOOK_RETRY
+    while True:
+        try:
+            bot.set_webhook(WEBHOOK_URL, api_kwargs={'secret_token': WEBHOOK_SECRET_TOKEN})
+            logger.info("Webhook registered")
+            return
+        except Exception:
+            logger.exception(f"Failed to register the webhook, retrying in {delay}s")
+        time.sleep(delay)
+        delay = min(delay * 2, SET_WEBHOOK_RETRY_MAX)
+
+
+def main():
+    global bot, ingestor, dedup
+    init_db()
+    dedup = UpdateDeduplicator()
+    dedup.load()
+    register_webhook_metrics()
+    if UPDATE_SHARDS:
+        bot = metrics.InstrumentedBot(BOT_TOKEN)
+        teardown = outbound.scheduler.stop
+        ingestor = ShardedIngestor(
+            setup_worker,
+            shards=UPDATE_SHARDS,
+            admin_chat_id=ADMIN_CHAT_ID,
+            max_queue=WEBHOOK_QUEUE_SIZE,
+            overload=WEBHOOK_OVERLOAD,
+        )
+    else:
+        # The only lane, so it also does the admin lane's jobs.
+        process, teardown = setup_worker(ADMIN_LANE, 1)
+        ingestor = UpdateIngestor(
+            process,
+            workers=WEBHOOK_WORKERS,
+            max_queue=WEBHOOK_QUEUE_SIZE,
+            overload=WEBHOOK_OVERLOAD,
+            classify=classify_update,
+            shed=shed_update,
+        )
+    ingestor.start()
+    # Telegram keeps the webhook between restarts; re-registering it is a
+    # network round trip, so it runs alongside the server instead of before it.
+    threading.Thread(target=register_webhook, name='set-webhook', daemon=True).start()
+    try:
+        app.run(host='0.0.0.0', port=PORT)
+    finally:
+        ingestor.stop()
+        dedup.close()
+        teardown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import hashlib
+import logging
+import os
+import threading
+
+from telegram.error import BadRequest
+
+from db import get_media_file_id, save_media_file_id, delete_media_file_id
+
+logger = logging.getLogger(__name__)
+
+# ------------------------- MEDIA CACHE -------------------------
+
+_lock = threading.Lock()
+# path -> (mtime_ns, size, sha256) so unchanged files are hashed once.
+_hashes = {}
+# sha256 -> Telegram file_id
+_file_ids = {}
+
+
+def file_hash(path: str) -> str:
+    st = os.stat(path)
+    with _lock:
+        cached = _hashes.get(path)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    value = digest.hexdigest()
+    with _lock:
+        _hashes[path] = (st.st_mtime_ns, st.st_size, value)
+    return value
+
+
+def _lookup(digest: str) -> str:
+    with _lock:
+        file_id = _file_ids.get(digest)
+    if file_id is None:
+        file_id = get_media_file_id(digest)
+        if file_id is not None:
+            with _lock:
+                _file_ids[digest] = file_id
+    return file_id
+
+
+def _forget(digest: str):
+    with _lock:
+        _file_ids.pop(digest, None)
+    delete_media_file_id(digest)
+
+
+def send_cached_photo(bot, chat_id, path: str, **kwargs):
+    """
+    Sends the photo at `path`, uploading its bytes only the first time (or after
+    the file changes) and reusing Telegram's file_id afterwards. A file_id that
+    Telegram rejects is dropped and the photo is uploaded again.
+    """
+    digest = file_hash(path)
+    file_id = _lookup(digest)
+    if file_id is not None:
+        try:
+            return bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        except BadRequest as e:
+            if 'file' not in str(e).lower():
+                raise
+            logger.warning(f"Cached file_id for {path} was rejected, uploading again: {e}")
+            _forget(digest)
+
+    with open(path, 'rb') as f:
+        message = bot.send_photo(chat_id=chat_id, photo=f, **kwargs)
+    # The largest size is last; any size's file_id resends the original upload.
+    file_id = message.photo[-1].file_id
+    save_media_file_id(digest, path, file_id)
+    with _lock:
+        _file_ids[digest] = file_id
+    return message
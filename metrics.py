@@ -0,0 +1,173 @@
+import bisect
+import threading
+import time
+
+from telegram import Bot
+from telegram.error import TelegramError
+from telegram.utils.helpers import DEFAULT_NONE
+
+# ------------------------- METRIC TYPES -------------------------
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SQLITE_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for label_values, value in items:
+            yield self.name, list(zip(self.labels, label_values)), value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [bucket counts..., +Inf count, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def samples(self):
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._values.items()]
+        for label_values, series in items:
+            labels = list(zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                le = bound if bound == '+Inf' else repr(float(bound))
+                yield f'{self.name}_bucket', labels + [('le', le)], cumulative
+            yield f'{self.name}_sum', labels, series[-1]
+            yield f'{self.name}_count', labels, cumulative
+
+
+class Gauge:
+    """Value read at scrape time from `fn`, which returns {label values tuple: number}."""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, help_text: str, fn, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.fn = fn
+
+    def samples(self):
+        for label_values, value in self.fn().items():
+            yield self.name, list(zip(self.labels, label_values)), value
+
+# ------------------------- REGISTRY -------------------------
+
+_registry = []
+
+
+def register(metric):
+    _registry.append(metric)
+    return metric
+
+
+def gauge(name: str, help_text: str, fn, labels=()):
+    return register(Gauge(name, help_text, fn, labels))
+
+
+def snapshot() -> list:
+    """
+    Current samples of every registered metric as (name, kind, help, samples).
+    Plain tuples, so worker processes can send theirs to the webhook process.
+    """
+    return [(metric.name, metric.kind, metric.help, list(metric.samples())) for metric in _registry]
+
+
+def render(remote=()) -> str:
+    """
+    All registered metrics in the Prometheus text exposition format. `remote`
+    holds (lane, snapshot()) pairs from worker processes; their samples are
+    merged into the same families with a `lane` label added.
+    """
+    families = {name: (kind, help_text, samples) for name, kind, help_text, samples in snapshot()}
+    for lane, metrics in remote:
+        for name, kind, help_text, samples in metrics:
+            family = families.setdefault(name, (kind, help_text, []))
+            family[2].extend((sample, labels + [('lane', lane)], value) for sample, labels, value in samples)
+    lines = []
+    for name, (kind, help_text, samples) in families.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        lines.extend(f'{sample}{_format_labels(labels)} {value}' for sample, labels, value in samples)
+    return '\n'.join(lines) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+HANDLER_LATENCY = register(Histogram(
+    'bot_handler_latency_seconds', 'Time spent in each update handler.', ['handler']))
+HANDLER_ERRORS = register(Counter(
+    'bot_handler_errors_total', 'Update handlers that raised.', ['handler']))
+TELEGRAM_CALLS = register(Counter(
+    'telegram_api_calls_total', 'Bot API requests by method.', ['method']))
+TELEGRAM_ERRORS = register(Counter(
+    'telegram_api_errors_total', 'Bot API requests that failed, by method and error.', ['method', 'error']))
+TELEGRAM_LATENCY = register(Histogram(
+    'telegram_api_latency_seconds', 'Bot API request latency by method.', ['method']))
+SQLITE_QUERIES = register(Histogram(
+    'sqlite_query_duration_seconds', 'SQLite statement execution time by statement type.',
+    ['statement'], buckets=SQLITE_BUCKETS))
+
+
+def observe_query(sql: str, seconds: float):
+    """db.query_observers hook: records the statement's leading keyword and duration."""
+    keyword = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else 'EMPTY'
+    SQLITE_QUERIES.observe(seconds, keyword)
+
+# ------------------------- INSTRUMENTED BOT -------------------------
+
+class InstrumentedBot(Bot):
+    """Bot that counts and times every API request by method."""
+
+    def _post(self, endpoint, data=None, timeout=DEFAULT_NONE, api_kwargs=None):
+        TELEGRAM_CALLS.inc(endpoint)
+        t0 = time.perf_counter()
+        try:
+            return super()._post(endpoint, data, timeout, api_kwargs)
+        except TelegramError as e:
+            TELEGRAM_ERRORS.inc(endpoint, type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_LATENCY.observe(time.perf_counter() - t0, endpoint)
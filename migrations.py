@@ -0,0 +1,252 @@
+# Numbered schema migrations applied by db.init_db().
+#
+# Each entry is (version, [statements]). The database's PRAGMA user_version
+# records the last version applied; init_db runs every newer entry in order,
+# each inside its own transaction. Never edit a migration that has shipped -
+# append a new one instead.
+
+MIGRATIONS = [
+    (1, [
+        '''CREATE TABLE IF NOT EXISTS applications (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                telegram_id INTEGER,
+                full_name TEXT,
+                phone TEXT,
+                linkedin_account TEXT,
+                password TEXT,
+                connections TEXT,
+                weekly_earning REAL,
+                status TEXT DEFAULT 'pending'
+            )''',
+        '''CREATE TABLE IF NOT EXISTS referrals (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                telegram_id INTEGER,
+                referral_code TEXT,
+                invited_count INTEGER DEFAULT 0
+            )''',
+        '''CREATE TABLE IF NOT EXISTS conversations (
+                user_id INTEGER PRIMARY KEY,
+                admin_id INTEGER,
+                last_contact DATETIME DEFAULT CURRENT_TIMESTAMP
+            )''',
+        '''CREATE TABLE IF NOT EXISTS actions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                telegram_id INTEGER,
+                action TEXT,
+                details TEXT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+            )''',
+    ]),
+    # Status lookups filter by telegram_id and take the newest row.
+    (2, [
+        'CREATE INDEX IF NOT EXISTS idx_applications_telegram_id ON applications (telegram_id, id)',
+    ]),
+    # Per-user audit history, newest first.
+    (3, [
+        'CREATE INDEX IF NOT EXISTS idx_actions_telegram_id ON actions (telegram_id, timestamp)',
+    ]),
+    # Telegram file_ids for uploaded assets, keyed by content hash.
+    (4, [
+        '''CREATE TABLE IF NOT EXISTS media_cache (
+                file_hash TEXT PRIMARY KEY,
+                path TEXT,
+                file_id TEXT NOT NULL,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )''',
+    ]),
+    # ConversationHandler states and user/chat/bot data (see persistence.py).
+    (5, [
+        '''CREATE TABLE IF NOT EXISTS persistence (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                data BLOB NOT NULL,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (kind, key)
+            ) WITHOUT ROWID''',
+    ]),
+    # Daily audit rollups and the bookkeeping for retention.py.
+    (6, [
+        '''CREATE TABLE IF NOT EXISTS action_daily (
+                day TEXT NOT NULL,
+                action TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, action)
+            ) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS maintenance_state (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            )''',
+        'CREATE INDEX IF NOT EXISTS idx_actions_timestamp ON actions (timestamp)',
+    ]),
+    # Running totals per application status, kept current by triggers so
+    # /stats never scans applications.
+    (7, [
+        '''CREATE TABLE IF NOT EXISTS application_stats (
+                status TEXT PRIMARY KEY,
+                applications INTEGER NOT NULL DEFAULT 0,
+                weekly_earning REAL NOT NULL DEFAULT 0
+            )''',
+        '''INSERT OR REPLACE INTO application_stats (status, applications, weekly_earning)
+            SELECT COALESCE(status, ''), COUNT(*), COALESCE(SUM(weekly_earning), 0)
+            FROM applications
+            GROUP BY COALESCE(status, '')''',
+        '''CREATE TRIGGER IF NOT EXISTS application_stats_insert AFTER INSERT ON applications
+            BEGIN
+                INSERT INTO application_stats (status, applications, weekly_earning)
+                VALUES (COALESCE(NEW.status, ''), 1, COALESCE(NEW.weekly_earning, 0))
+                ON CONFLICT(status) DO UPDATE SET
+                    applications = applications + 1,
+                    weekly_earning = weekly_earning + excluded.weekly_earning;
+            END''',
+        '''CREATE TRIGGER IF NOT EXISTS application_stats_delete AFTER DELETE ON applications
+            BEGIN
+                UPDATE application_stats
+                SET applications = applications - 1,
+                    weekly_earning = weekly_earning - COALESCE(OLD.weekly_earning, 0)
+                WHERE status = COALESCE(OLD.status, '');
+            END''',
+        '''CREATE TRIGGER IF NOT EXISTS application_stats_update
+            AFTER UPDATE OF status, weekly_earning ON applications
+            BEGIN
+                UPDATE application_stats
+                SET applications = applications - 1,
+                    weekly_earning = weekly_earning - COALESCE(OLD.weekly_earning, 0)
+                WHERE status = COALESCE(OLD.status, '');
+                INSERT INTO application_stats (status, applications, weekly_earning)
+                VALUES (COALESCE(NEW.status, ''), 1, COALESCE(NEW.weekly_earning, 0))
+                ON CONFLICT(status) DO UPDATE SET
+                    applications = applications + 1,
+                    weekly_earning = weekly_earning + excluded.weekly_earning;
+            END''',
+    ]),
+    # Full-text index for /find over applicant names, LinkedIn accounts and
+    # ids, stored externally against applications and kept in sync by triggers.
+    (8, [
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS applications_fts USING fts5(
+                full_name, linkedin_account, telegram_id,
+                content='applications', content_rowid='id',
+                prefix='2 3'
+            )''',
+        "INSERT INTO applications_fts (applications_fts) VALUES ('rebuild')",
+        '''CREATE TRIGGER IF NOT EXISTS applications_fts_insert AFTER INSERT ON applications
+            BEGIN
+                INSERT INTO applications_fts (rowid, full_name, linkedin_account, telegram_id)
+                VALUES (NEW.id, NEW.full_name, NEW.linkedin_account, NEW.telegram_id);
+            END''',
+        '''CREATE TRIGGER IF NOT EXISTS applications_fts_delete AFTER DELETE ON applications
+            BEGIN
+                INSERT INTO applications_fts (applications_fts, rowid, full_name, linkedin_account, telegram_id)
+                VALUES ('delete', OLD.id, OLD.full_name, OLD.linkedin_account, OLD.telegram_id);
+            END''',
+        '''CREATE TRIGGER IF NOT EXISTS applications_fts_update
+            AFTER UPDATE OF full_name, linkedin_account, telegram_id ON applications
+            BEGIN
+                INSERT INTO applications_fts (applications_fts, rowid, full_name, linkedin_account, telegram_id)
+                VALUES ('delete', OLD.id, OLD.full_name, OLD.linkedin_account, OLD.telegram_id);
+                INSERT INTO applications_fts (rowid, full_name, linkedin_account, telegram_id)
+                VALUES (NEW.id, NEW.full_name, NEW.linkedin_account, NEW.telegram_id);
+            END''',
+    ]),
+    # Referrals: one code per user, codes resolved from /start deep links,
+    # each invitee credited once, and the leaderboard read from an index.
+    # Duplicate rows from before the unique indexes are folded into the
+    # oldest one first.
+    (9, [
+        '''UPDATE referrals SET invited_count = (
+                SELECT SUM(COALESCE(r.invited_count, 0)) FROM referrals r WHERE r.telegram_id = referrals.telegram_id
+            )
+            WHERE id IN (SELECT MIN(id) FROM referrals GROUP BY telegram_id HAVING COUNT(*) > 1)''',
+        '''DELETE FROM referrals
+            WHERE id NOT IN (SELECT MIN(id) FROM referrals GROUP BY telegram_id)''',
+        '''UPDATE referrals SET referral_code = NULL
+            WHERE referral_code IS NOT NULL
+            AND id NOT IN (SELECT MIN(id) FROM referrals WHERE referral_code IS NOT NULL GROUP BY referral_code)''',
+        'UPDATE referrals SET invited_count = 0 WHERE invited_count IS NULL',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_referrals_telegram_id ON referrals (telegram_id)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_referrals_code ON referrals (referral_code)',
+        'CREATE INDEX IF NOT EXISTS idx_referrals_invited_count ON referrals (invited_count, id)',
+        '''CREATE TABLE IF NOT EXISTS referral_invites (
+                invitee_id INTEGER PRIMARY KEY,
+                referrer_id INTEGER NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )''',
+    ]),
+    # Admin relay: the admin-chat message a user's last message was relayed
+    # as, so replies to it still route after a restart, and an index for
+    # loading recent conversations at startup.
+    (10, [
+        'ALTER TABLE conversations ADD COLUMN last_message_id INTEGER',
+        'CREATE INDEX IF NOT EXISTS idx_conversations_last_contact ON conversations (last_contact)',
+    ]),
+    # application_stats counted every applications row, so a user who applied
+    # twice showed up twice, once under their old status. Count only each
+    # user's latest application (the one reviews update): a newer row moves
+    # the user out of the previous row's bucket, and deleting the latest row
+    # moves them back. Rows without a telegram_id aren't anyone's application.
+    (11, [
+        'DROP TRIGGER IF EXISTS application_stats_insert',
+        'DROP TRIGGER IF EXISTS application_stats_delete',
+        'DROP TRIGGER IF EXISTS application_stats_update',
+        'DELETE FROM application_stats',
+        '''INSERT INTO application_stats (status, applications, weekly_earning)
+            SELECT COALESCE(status, ''), COUNT(*), COALESCE(SUM(weekly_earning), 0)
+            FROM applications
+            WHERE id = (SELECT MAX(id) FROM applications AS newer WHERE newer.telegram_id = applications.telegram_id)
+            GROUP BY COALESCE(status, '')''',
+        '''CREATE TRIGGER IF NOT EXISTS application_stats_insert AFTER INSERT ON applications
+            WHEN NEW.telegram_id IS NOT NULL AND NOT EXISTS (
+                SELECT 1 FROM applications WHERE telegram_id = NEW.telegram_id AND id > NEW.id)
+            BEGIN
+                UPDATE application_stats
+                SET applications = applications - 1,
+                    weekly_earning = weekly_earning - (
+                        SELECT COALESCE(weekly_earning, 0) FROM applications
+                        WHERE telegram_id = NEW.telegram_id AND id < NEW.id ORDER BY id DESC LIMIT 1)
+                WHERE status = (
+                    SELECT COALESCE(status, '') FROM applications
+                    WHERE telegram_id = NEW.telegram_id AND id < NEW.id ORDER BY id DESC LIMIT 1);
+                INSERT INTO application_stats (status, applications, weekly_earning)
+                VALUES (COALESCE(NEW.status, ''), 1, COALESCE(NEW.weekly_earning, 0))
+                ON CONFLICT(status) DO UPDATE SET
+                    applications = applications + 1,
+                    weekly_earning = weekly_earning + excluded.weekly_earning;
+            END''',
+        '''CREATE TRIGGER IF NOT EXISTS application_stats_delete AFTER DELETE ON applications
+            WHEN OLD.telegram_id IS NOT NULL AND NOT EXISTS (
+                SELECT 1 FROM applications WHERE telegram_id = OLD.telegram_id AND id > OLD.id)
+            BEGIN
+                UPDATE application_stats
+                SET applications = applications - 1,
+                    weekly_earning = weekly_earning - COALESCE(OLD.weekly_earning, 0)
+                WHERE status = COALESCE(OLD.status, '');
+                INSERT INTO application_stats (status, applications, weekly_earning)
+                SELECT COALESCE(status, ''), 1, COALESCE(weekly_earning, 0) FROM applications
+                WHERE telegram_id = OLD.telegram_id ORDER BY id DESC LIMIT 1
+                ON CONFLICT(status) DO UPDATE SET
+                    applications = applications + 1,
+                    weekly_earning = weekly_earning + excluded.weekly_earning;
+            END''',
+        '''CREATE TRIGGER IF NOT EXISTS application_stats_update
+            AFTER UPDATE OF status, weekly_earning ON applications
+            WHEN OLD.telegram_id IS NOT NULL AND NOT EXISTS (
+                SELECT 1 FROM applications WHERE telegram_id = OLD.telegram_id AND id > OLD.id)
+            BEGIN
+                UPDATE application_stats
+                SET applications = applications - 1,
+                    weekly_earning = weekly_earning - COALESCE(OLD.weekly_earning, 0)
+                WHERE status = COALESCE(OLD.status, '');
+                INSERT INTO application_stats (status, applications, weekly_earning)
+                VALUES (COALESCE(NEW.status, ''), 1, COALESCE(NEW.weekly_earning, 0))
+                ON CONFLICT(status) DO UPDATE SET
+                    applications = applications + 1,
+                    weekly_earning = weekly_earning + excluded.weekly_earning;
+            END''',
+    ]),
+    # Nothing reads the audit log by user, so the index from migration 3 only
+    # slowed down every audit insert.
+    (12, [
+        'DROP INDEX IF EXISTS idx_actions_telegram_id',
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
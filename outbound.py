@@ -0,0 +1,299 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Telegram's documented limits: ~30 messages/s per bot, ~1 message/s per chat.
+# The per-chat limit is for messages sent; calls submitted with per_chat=False
+# (callback answers, deletions) skip the chat's bucket.
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+CHAT_RATE = 1
+CHAT_BURST = 3
+
+# Threads making the actual HTTP calls, so one slow request doesn't stall the rest.
+SEND_THREADS = 8
+
+# Give up on a call after this many 429s.
+MAX_RETRIES = 5
+
+INTERACTIVE = 0
+BULK = 1
+
+# ------------------------- TOKEN BUCKET -------------------------
+
+class TokenBucket:
+    """Classic token bucket; not thread-safe, the scheduler serialises access."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available (0 if one is available now)."""
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, until: float):
+        self.paused_until = max(self.paused_until, until)
+        self.tokens = 0
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.paused_until
+
+# ------------------------- SEND SCHEDULER -------------------------
+
+class _Job:
+    __slots__ = ('chat_id', 'priority', 'per_chat', 'fn', 'args', 'kwargs', 'future', 'attempts')
+
+    def __init__(self, chat_id, priority, per_chat, fn, args, kwargs):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.per_chat = per_chat
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.attempts = 0
+
+
+class _Chat:
+    __slots__ = ('bucket', 'queues', 'entry')
+
+    def __init__(self, rate, burst):
+        self.bucket = TokenBucket(rate, burst)
+        self.queues = (deque(), deque())  # INTERACTIVE, BULK
+        # (ready_at, priority, seq, chat_id) of the chat's live schedule entry
+        self.entry = None
+
+    def head(self):
+        return self.queues[INTERACTIVE] or self.queues[BULK]
+
+    def priority(self):
+        return INTERACTIVE if self.queues[INTERACTIVE] else BULK
+
+
+class SendScheduler:
+    """
+    Central throttle for outbound Bot API calls. Every call is tagged with the
+    chat it targets and a priority; a single scheduling thread releases calls
+    only when both the global and the chat's token bucket allow it, always
+    preferring INTERACTIVE work over BULK, and re-queues calls that Telegram
+    answered with 429 after the retry_after it asked for. Calls run on a small
+    thread pool and their results are delivered through Futures.
+
+    Calls that don't send a message (per_chat=False) only wait for the global
+    bucket and go ahead of everything else, so a spinner stops right away
+    even while the chat's sends are throttled.
+    """
+
+    def __init__(self, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST,
+                 chat_rate=CHAT_RATE, chat_burst=CHAT_BURST, threads=SEND_THREADS):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chats = {}
+        # Chats with pending jobs: by ready_at until their time comes, then by
+        # (priority, seq). Entries replaced by a newer one for the chat are skipped.
+        self._waiting = []
+        self._ready = []
+        self._unmetered = deque()
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='send')
+        self._thread = None
+        self._stopping = False
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.pending = 0
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name='send-scheduler', daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        """Sends everything already queued, then stops."""
+        with self._cond:
+            thread = self._thread
+            self._stopping = True
+            self._cond.notify()
+        if thread is not None:
+            thread.join(timeout)
+        self._executor.shutdown(wait=True)
+        self._thread = None
+
+    def submit(self, chat_id, fn, /, *args, priority=INTERACTIVE, per_chat=True, **kwargs) -> Future:
+        """
+        Schedules fn(*args, **kwargs) as a message to `chat_id`. Wait on the
+        returned Future for the result, or ignore it to fire and forget.
+        """
+        if self._thread is None:
+            self.start()
+        job = _Job(chat_id, priority, per_chat, fn, args, kwargs)
+        with self._cond:
+            self._enqueue(job, front=False)
+            self.pending += 1
+            self._cond.notify()
+        return job.future
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'pending': self.pending,
+                'chats': len(self._chats),
+                'sent': self.sent,
+                'failed': self.failed,
+                'retried': self.retried,
+            }
+
+    def _enqueue(self, job, front):
+        if not job.per_chat:
+            if front:
+                self._unmetered.appendleft(job)
+            else:
+                self._unmetered.append(job)
+            return
+        chat = self._chats.get(job.chat_id)
+        if chat is None:
+            chat = self._chats[job.chat_id] = _Chat(self.chat_rate, self.chat_burst)
+        if front:
+            chat.queues[job.priority].appendleft(job)
+        else:
+            chat.queues[job.priority].append(job)
+        self._schedule(job.chat_id, chat, time.monotonic())
+
+    def _schedule(self, chat_id, chat, now):
+        if not chat.head():
+            return
+        priority = chat.priority()
+        if chat.entry is not None:
+            if chat.entry[1] <= priority:
+                return
+            # An INTERACTIVE job joined a chat scheduled as BULK: move it up.
+            ready_at = chat.entry[0]
+        else:
+            ready_at = now + chat.bucket.delay(now)
+        chat.entry = (ready_at, priority, next(self._seq), chat_id)
+        heapq.heappush(self._waiting, chat.entry)
+
+    def _next_job(self, now):
+        """Pops the highest-priority job whose chat is ready, or returns the wait time."""
+        while self._waiting and self._waiting[0][0] <= now:
+            _, priority, seq, chat_id = heapq.heappop(self._waiting)
+            heapq.heappush(self._ready, (priority, seq, chat_id))
+        while self._ready:
+            _, seq, chat_id = heapq.heappop(self._ready)
+            chat = self._chats[chat_id]
+            if chat.entry is None or chat.entry[2] != seq:
+                continue
+            chat.entry = None
+            # A 429 may have paused the chat after this entry was pushed.
+            if chat.bucket.delay(now) > 0:
+                self._schedule(chat_id, chat, now)
+                continue
+            job = chat.head().popleft()
+            chat.bucket.consume(now)
+            self._schedule(chat_id, chat, now)
+            return job, 0
+        return None, (self._waiting[0][0] - now) if self._waiting else None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                global_wait = self._global.delay(now)
+                if global_wait > 0:
+                    self._cond.wait(global_wait)
+                    continue
+                if self._unmetered:
+                    job, wait = self._unmetered.popleft(), 0
+                else:
+                    job, wait = self._next_job(now)
+                if job is None:
+                    if self._stopping and self.pending == 0:
+                        return
+                    self._cond.wait(wait)
+                    continue
+                self._global.consume(now)
+                self._prune(now)
+            self._executor.submit(self._call, job)
+
+    def _prune(self, now):
+        # Forget idle chats so the map doesn't grow with every user ever seen.
+        if len(self._chats) < 10000:
+            return
+        for chat_id in [cid for cid, c in self._chats.items()
+                        if c.entry is None and not c.head() and c.bucket.idle(now)]:
+            del self._chats[chat_id]
+
+    def _call(self, job):
+        job.attempts += 1
+        try:
+            result = job.fn(*job.args, **job.kwargs)
+        except RetryAfter as e:
+            if job.attempts < MAX_RETRIES:
+                logger.warning(f"Flood control for chat {job.chat_id}, retrying in {e.retry_after}s")
+                with self._cond:
+                    self.retried += 1
+                    until = time.monotonic() + e.retry_after
+                    self._global.pause(until)
+                    chat = self._chats.get(job.chat_id)
+                    if chat is not None:
+                        chat.bucket.pause(until)
+                    self._enqueue(job, front=True)
+                    self._cond.notify()
+                return
+            self._finish(job, exc=e)
+        except Exception as e:
+            self._finish(job, exc=e)
+        else:
+            self._finish(job, result=result)
+
+    def _finish(self, job, result=None, exc=None):
+        with self._cond:
+            self.pending -= 1
+            if exc is None:
+                self.sent += 1
+            else:
+                self.failed += 1
+            self._cond.notify()
+        if exc is None:
+            job.future.set_result(result)
+        else:
+            if job.priority == BULK:
+                logger.error(f"Failed to send to chat {job.chat_id}: {exc}")
+            job.future.set_exception(exc)
+
+
+scheduler = SendScheduler()
+
+
+def submit(chat_id, fn, /, *args, priority=INTERACTIVE, per_chat=True, **kwargs) -> Future:
+    return scheduler.submit(chat_id, fn, *args, priority=priority, per_chat=per_chat, **kwargs)
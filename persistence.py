@@ -0,0 +1,217 @@
+import hashlib
+import logging
+import pickle
+import threading
+from collections import defaultdict
+
+from telegram.ext import BasePersistence
+
+from db import get_connection, transaction
+
+logger = logging.getLogger(__name__)
+
+# Seconds between background flushes of changed state.
+FLUSH_INTERVAL = 5
+
+USER = 'user'
+CHAT = 'chat'
+BOT = 'bot'
+CONVERSATION = 'conv:'
+
+# ------------------------- STORAGE -------------------------
+
+def _load(kind: str, key: str):
+    row = get_connection().execute(
+        'SELECT data FROM persistence WHERE kind = ? AND key = ?', (kind, key)
+    ).fetchone()
+    return pickle.loads(row[0]) if row else None
+
+
+def _encode_key(key) -> str:
+    # Conversation keys are tuples of ids; everything else is a single id.
+    if isinstance(key, tuple):
+        return ','.join(str(part) for part in key)
+    return str(key)
+
+
+class _LazyData(defaultdict):
+    """
+    defaultdict that loads an entry from SQLite the first time it is looked up,
+    so startup doesn't have to read every stored user.
+    """
+
+    def __init__(self, kind: str):
+        super().__init__(dict)
+        self.kind = kind
+
+    def __missing__(self, key):
+        value = _load(self.kind, _encode_key(key))
+        if value is None:
+            value = {}
+        self[key] = value
+        return value
+
+    # BasePersistence.insert_bot copies what get_*_data returns; keep the
+    # lazy loader instead of a plain snapshot.
+    def __copy__(self):
+        return self
+
+    def copy(self):
+        return dict(self)
+
+
+class _LazyConversations(dict):
+    """Conversation states keyed by (chat_id, user_id), loaded on first lookup."""
+
+    def __init__(self, kind: str):
+        super().__init__()
+        self.kind = kind
+        self._checked = set()
+
+    def _ensure(self, key):
+        if key in self._checked or dict.__contains__(self, key):
+            return
+        self._checked.add(key)
+        state = _load(self.kind, _encode_key(key))
+        if state is not None:
+            dict.__setitem__(self, key, state)
+
+    def get(self, key, default=None):
+        self._ensure(key)
+        return dict.get(self, key, default)
+
+    def __contains__(self, key):
+        self._ensure(key)
+        return dict.__contains__(self, key)
+
+    def __getitem__(self, key):
+        self._ensure(key)
+        return dict.__getitem__(self, key)
+
+# ------------------------- PERSISTENCE -------------------------
+
+class SQLitePersistence(BasePersistence):
+    """
+    Stores conversation states and user/chat/bot data in the bot's SQLite
+    database. Updates only mark entries dirty; a background thread writes the
+    ones whose serialized form actually changed every `flush_interval`
+    seconds, and flush() (called by PTB on shutdown) writes the rest.
+    """
+
+    def __init__(self, store_user_data=True, store_chat_data=True, store_bot_data=True,
+                 flush_interval=FLUSH_INTERVAL):
+        super().__init__(store_user_data=store_user_data, store_chat_data=store_chat_data,
+                         store_bot_data=store_bot_data)
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._dirty = {}
+        # (kind, key) -> digest of what is on disk, to skip unchanged writes
+        self._written = {}
+        self._conversations = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='persistence-flush', daemon=True)
+        self._thread.start()
+        self.writes = 0
+        self.skipped = 0
+
+    def get_user_data(self):
+        return _LazyData(USER)
+
+    def get_chat_data(self):
+        return _LazyData(CHAT)
+
+    def get_bot_data(self):
+        return _load(BOT, '') or {}
+
+    def get_conversations(self, name):
+        if name not in self._conversations:
+            self._conversations[name] = _LazyConversations(CONVERSATION + name)
+        return self._conversations[name]
+
+    def update_conversation(self, name, key, new_state):
+        self._mark(CONVERSATION + name, _encode_key(key), new_state)
+
+    def update_user_data(self, user_id, data):
+        self._mark(USER, _encode_key(user_id), data)
+
+    def update_chat_data(self, chat_id, data):
+        self._mark(CHAT, _encode_key(chat_id), data)
+
+    def update_bot_data(self, data):
+        self._mark(BOT, '', data)
+
+    def refresh_user_data(self, user_id, user_data):
+        pass
+
+    def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    def refresh_bot_data(self, bot_data):
+        pass
+
+    def flush(self):
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return
+        upserts, deletes = [], []
+        for (kind, key), value in dirty.items():
+            if value is None:
+                deletes.append((kind, key))
+                self._written.pop((kind, key), None)
+                continue
+            try:
+                blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                # Unpicklable, or changed by a handler mid-dump: keep it for
+                # the next flush instead of losing it.
+                logger.error(f"Failed to pickle {kind} {key}: {e}")
+                with self._lock:
+                    self._dirty.setdefault((kind, key), value)
+                continue
+            digest = hashlib.blake2b(blob, digest_size=16).digest()
+            if self._written.get((kind, key)) == digest:
+                self.skipped += 1
+                continue
+            upserts.append((kind, key, blob))
+            self._written[(kind, key)] = digest
+        if not upserts and not deletes:
+            return
+        try:
+            with transaction() as conn:
+                conn.executemany('''INSERT INTO persistence (kind, key, data) VALUES (?, ?, ?)
+                                    ON CONFLICT(kind, key) DO UPDATE SET
+                                        data = excluded.data,
+                                        updated_at = CURRENT_TIMESTAMP''', upserts)
+                conn.executemany('DELETE FROM persistence WHERE kind = ? AND key = ?', deletes)
+            self.writes += len(upserts) + len(deletes)
+        except Exception as e:
+            logger.error(f"Failed to flush persistence: {e}")
+            # Forget what we thought was written and retry on the next flush.
+            with self._lock:
+                for kind, key, _ in upserts:
+                    self._written.pop((kind, key), None)
+                    self._dirty.setdefault((kind, key), dirty[(kind, key)])
+                for entry in deletes:
+                    self._dirty.setdefault(entry, None)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+
+    def _mark(self, kind, key, value):
+        with self._lock:
+            self._dirty[(kind, key)] = value
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Persistence flush failed: {e}", exc_info=True)
@@ -0,0 +1,106 @@
+import logging
+import re
+import threading
+
+from db import get_connection, query_observers
+
+logger = logging.getLogger(__name__)
+
+# Statements slower than this are logged with their query plan.
+SLOW_QUERY_MS = 50
+
+_COMMENTS = re.compile(r'--[^\n]*|/\*.*?\*/', re.S)
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_NUMBERS = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_SPACES = re.compile(r'\s+')
+_EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE')
+
+
+def normalize(sql: str) -> str:
+    """Reduces a statement to its shape: literals become ?, whitespace collapses."""
+    shape = _COMMENTS.sub(' ', sql)
+    shape = _STRINGS.sub('?', shape)
+    shape = _NUMBERS.sub('?', shape)
+    shape = _IN_LISTS.sub('(?...)', shape)
+    return _SPACES.sub(' ', shape).strip()
+
+
+class QueryProfiler:
+    """
+    db.query_observers hook that aggregates call count, total and max time per
+    statement shape, and logs statements slower than `slow_ms` together with
+    their EXPLAIN QUERY PLAN (computed once per shape).
+    """
+
+    def __init__(self, slow_ms: float = SLOW_QUERY_MS):
+        self.slow_ms = slow_ms
+        self._stats = {}
+        self._plans = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.slow_queries = 0
+
+    def install(self):
+        if self.observe not in query_observers:
+            query_observers.append(self.observe)
+
+    def uninstall(self):
+        if self.observe in query_observers:
+            query_observers.remove(self.observe)
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self.slow_queries = 0
+
+    def observe(self, sql: str, seconds: float):
+        if getattr(self._local, 'explaining', False):
+            return
+        shape = normalize(sql)
+        with self._lock:
+            entry = self._stats.get(shape)
+            if entry is None:
+                entry = self._stats[shape] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+        if seconds * 1000 >= self.slow_ms:
+            self.slow_queries += 1
+            logger.warning(f"Slow query ({seconds * 1000:.1f} ms): {shape}\n    plan: {self._plan(sql, shape)}")
+
+    def _plan(self, sql: str, shape: str) -> str:
+        if shape in self._plans:
+            return self._plans[shape]
+        if shape.split(' ', 1)[0].upper() not in _EXPLAINABLE:
+            return 'n/a'
+        self._local.explaining = True
+        try:
+            # Placeholder values don't change which indexes SQLite picks.
+            params = (None,) * sql.count('?')
+            rows = get_connection().execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()
+            plan = '; '.join(row[3] for row in rows)
+        except Exception as e:
+            plan = f'unavailable ({e})'
+        finally:
+            self._local.explaining = False
+        self._plans[shape] = plan
+        return plan
+
+    def top(self, n: int = 10, key: str = 'total'):
+        """Returns the top `n` shapes as (shape, count, total_s, max_s), sorted by `key`."""
+        index = {'count': 0, 'total': 1, 'max': 2}[key]
+        with self._lock:
+            items = [(shape, *entry) for shape, entry in self._stats.items()]
+        items.sort(key=lambda item: item[index + 1], reverse=True)
+        return items[:n]
+
+    def report(self, n: int = 10) -> str:
+        lines = []
+        for shape, count, total, worst in self.top(n):
+            lines.append(f"{total * 1000:.1f} ms total, {count} calls, "
+                         f"{total / count * 1000:.2f} ms avg, {worst * 1000:.1f} ms max\n  {shape}")
+        return '\n'.join(lines) if lines else 'No queries recorded.'
+
+
+profiler = QueryProfiler()
@@ -0,0 +1,93 @@
+import secrets
+import sqlite3
+
+from cache import MISSING, TTLCache
+from db import get_connection, transaction
+
+CODE_BYTES = 6  # secrets.token_urlsafe(6) gives 8 deep-link-safe characters
+CODE_ATTEMPTS = 5
+
+LEADERBOARD_SIZE = 50  # Only the top K referrers are ranked
+LEADERBOARD_PAGE_SIZE = 10
+LEADERBOARD_TTL = 30  # Seconds a leaderboard page is served from memory
+
+_leaderboard_cache = TTLCache(maxsize=LEADERBOARD_SIZE // LEADERBOARD_PAGE_SIZE + 1, ttl=LEADERBOARD_TTL)
+
+REFERRAL_SQL = 'SELECT referral_code, invited_count FROM referrals WHERE telegram_id = ?'
+RESOLVE_CODE_SQL = 'SELECT telegram_id FROM referrals WHERE referral_code = ?'
+CREDIT_SQL = 'UPDATE referrals SET invited_count = invited_count + 1 WHERE telegram_id = ?'
+# Walks idx_referrals_invited_count backwards; the name lookup per row uses
+# idx_applications_telegram_id.
+LEADERBOARD_SQL = '''
+    SELECT r.telegram_id, r.invited_count, (
+        SELECT full_name FROM applications a
+        WHERE a.telegram_id = r.telegram_id
+        ORDER BY a.id DESC LIMIT 1
+    )
+    FROM referrals r
+    WHERE r.invited_count > 0
+    ORDER BY r.invited_count DESC, r.id DESC
+    LIMIT ? OFFSET ?
+'''
+
+
+def get_referral(telegram_id: int):
+    """(referral_code, invited_count) for a user, creating the code on first use."""
+    conn = get_connection()
+    row = conn.execute(REFERRAL_SQL, (telegram_id,)).fetchone()
+    if row and row[0]:
+        return row
+    for _ in range(CODE_ATTEMPTS):
+        try:
+            with transaction() as conn:
+                # A concurrent call for the same user may win; its code is kept.
+                conn.execute('''INSERT INTO referrals (telegram_id, referral_code) VALUES (?, ?)
+                                ON CONFLICT(telegram_id) DO UPDATE SET referral_code = excluded.referral_code
+                                WHERE referral_code IS NULL''',
+                             (telegram_id, secrets.token_urlsafe(CODE_BYTES)))
+        except sqlite3.IntegrityError:
+            continue  # The code is taken by someone else; draw another.
+        return conn.execute(REFERRAL_SQL, (telegram_id,)).fetchone()
+    raise RuntimeError(f"Could not allocate a referral code for {telegram_id}")
+
+
+def credit_referral(invitee_id: int, code: str):
+    """
+    Credits the owner of `code` with a new invite and returns their telegram_id,
+    or None when the code is unknown, is the invitee's own, or the invitee was
+    already credited to someone. The invite record and the counter increment
+    commit together, so concurrent /start taps can't double count.
+    """
+    conn = get_connection()
+    row = conn.execute(RESOLVE_CODE_SQL, (code,)).fetchone()
+    if row is None or row[0] == invitee_id:
+        return None
+    referrer_id = row[0]
+    with transaction() as conn:
+        cursor = conn.execute('''INSERT INTO referral_invites (invitee_id, referrer_id) VALUES (?, ?)
+                                 ON CONFLICT(invitee_id) DO NOTHING''', (invitee_id, referrer_id))
+        if cursor.rowcount != 1:
+            return None
+        conn.execute(CREDIT_SQL, (referrer_id,))
+    return referrer_id
+
+
+def get_leaderboard(page: int = 0):
+    """
+    One page of the top LEADERBOARD_SIZE referrers as ([(rank, telegram_id,
+    full_name, invited_count)], has_next). Pages are cached for LEADERBOARD_TTL
+    seconds, so menu traffic doesn't re-run the query.
+    """
+    cached = _leaderboard_cache.get(page)
+    if cached is not MISSING:
+        return cached
+    offset = page * LEADERBOARD_PAGE_SIZE
+    limit = min(LEADERBOARD_PAGE_SIZE, LEADERBOARD_SIZE - offset)
+    if limit <= 0:
+        return [], False
+    rows = get_connection().execute(LEADERBOARD_SQL, (limit + 1, offset)).fetchall()
+    has_next = len(rows) > limit and offset + limit < LEADERBOARD_SIZE
+    result = ([(offset + i + 1, telegram_id, full_name, count)
+               for i, (telegram_id, count, full_name) in enumerate(rows[:limit])], has_next)
+    _leaderboard_cache.add(page, result)
+    return result
@@ -0,0 +1,198 @@
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from telegram.ext import MessageFilter
+
+from db import get_connection, transaction
+
+logger = logging.getLogger(__name__)
+
+# Replies are routed for conversations active within this many days.
+OPEN_DAYS = 7
+# Admin-chat messages remembered for routing; the oldest are forgotten first.
+MAX_ROUTES = 50000
+# Seconds between background writes of last_contact.
+FLUSH_INTERVAL = 5
+
+# Every relayed message starts with this header, so a reply to one the map
+# has forgotten can still be routed from its text.
+HEADER = '💬 {name} (ID: {user_id})'
+# Anchored at the end so a name containing "(ID: ...)" can't redirect replies.
+_HEADER_ID = re.compile(r'\(ID: (\d+)\)$')
+
+# Walks idx_conversations_last_contact.
+LOAD_SQL = '''
+    SELECT user_id, last_message_id, CAST(strftime('%s', last_contact) AS INTEGER)
+    FROM conversations
+    WHERE last_contact >= datetime('now', ?)
+'''
+# Primary key lookup.
+LAST_CONTACT_SQL = "SELECT CAST(strftime('%s', last_contact) AS INTEGER) FROM conversations WHERE user_id = ?"
+SAVE_SQL = '''
+    INSERT INTO conversations (user_id, admin_id, last_contact, last_message_id)
+    VALUES (?, ?, datetime(?, 'unixepoch'), ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        admin_id = excluded.admin_id,
+        last_contact = MAX(last_contact, excluded.last_contact),
+        last_message_id = COALESCE(excluded.last_message_id, last_message_id)
+'''
+
+
+def header(user_id: int, name: str = 'User') -> str:
+    return HEADER.format(name=name, user_id=user_id)
+
+
+class RelayRoutes:
+    """
+    In-memory routing for the admin relay. Maps the admin-chat message_id of
+    each relayed message to the user it came from, and tracks when each user
+    last talked to an admin. Lookups never touch SQLite: the table is read
+    once by load(), and last_contact changes are written in batches by a
+    background thread every `flush_interval` seconds.
+
+    With UPDATE_SHARDS each process keeps its own routes (load(shared=True)).
+    A reply the admin lane has no route for is resolved from the ID in the
+    message header. Conversations an admin opens are written right away, and
+    is_open() looks up users it has no open conversation with in the table,
+    so the user's shard still relays their answers.
+    """
+
+    def __init__(self, max_routes: int = MAX_ROUTES, flush_interval: float = FLUSH_INTERVAL,
+                 open_days: int = OPEN_DAYS):
+        self.max_routes = max_routes
+        self.flush_interval = flush_interval
+        self.open_days = open_days
+        self.open_seconds = open_days * 86400
+        self._routes = OrderedDict()
+        self._last_contact = {}
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+        self.shared = False
+        self.routed = 0
+        self.from_header = 0
+        self.writes = 0
+
+    def load(self, shared: bool = False):
+        """
+        Reads recent conversations and starts the background writer. `shared`
+        means other processes record conversations in the same table.
+        """
+        self.shared = shared
+        rows = get_connection().execute(LOAD_SQL, (f'-{self.open_days} days',)).fetchall()
+        with self._lock:
+            for user_id, message_id, last_contact in rows:
+                self._last_contact.setdefault(user_id, last_contact)
+                if message_id is not None:
+                    self._routes.setdefault(message_id, user_id)
+            while len(self._routes) > self.max_routes:
+                self._routes.popitem(last=False)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='relay-flush', daemon=True)
+            self._thread.start()
+
+    def record(self, user_id: int, admin_id: int, message_id: int = None):
+        """
+        Notes contact with `user_id`. `message_id` is the admin-chat message
+        that replies to should reach them through.
+        """
+        now = int(time.time())
+        with self._lock:
+            self._last_contact[user_id] = now
+            if message_id is not None:
+                self._routes[message_id] = user_id
+                self._routes.move_to_end(message_id)
+                if len(self._routes) > self.max_routes:
+                    self._routes.popitem(last=False)
+            previous = self._dirty.get(user_id)
+            if message_id is None and previous is not None:
+                message_id = previous[3]
+            self._dirty[user_id] = (user_id, admin_id, now, message_id)
+
+    def open(self, user_id: int, admin_id: int, message_id: int = None):
+        """
+        record() for contact an admin started. When shared, it is written
+        right away instead of at the next flush, so the user's process sees it.
+        """
+        self.record(user_id, admin_id, message_id)
+        if self.shared:
+            self._wake.set()
+
+    def user_for(self, message):
+        """The user a reply to admin-chat `message` should go to, or None."""
+        with self._lock:
+            user_id = self._routes.get(message.message_id)
+        if user_id is not None:
+            self.routed += 1
+            return user_id
+        found = _HEADER_ID.search((message.text or message.caption or '').split('\n', 1)[0])
+        if found:
+            self.from_header += 1
+            return int(found.group(1))
+        return None
+
+    def is_open(self, user_id: int) -> bool:
+        last_contact = self._last_contact.get(user_id)
+        if self.shared and (last_contact is None or time.time() - last_contact >= self.open_seconds):
+            # Another process may have opened the conversation since. Only
+            # users without an open conversation here pay for the lookup.
+            row = get_connection().execute(LAST_CONTACT_SQL, (user_id,)).fetchone()
+            if row is not None and row[0] is not None:
+                with self._lock:
+                    last_contact = max(self._last_contact.get(user_id, row[0]), row[0])
+                    self._last_contact[user_id] = last_contact
+        return last_contact is not None and time.time() - last_contact < self.open_seconds
+
+    def flush(self):
+        with self._lock:
+            rows, self._dirty = list(self._dirty.values()), {}
+        if not rows:
+            return
+        try:
+            with transaction() as conn:
+                conn.executemany(SAVE_SQL, rows)
+            self.writes += len(rows)
+        except Exception as e:
+            logger.error(f"Failed to save {len(rows)} conversation(s): {e}")
+            with self._lock:
+                for row in rows:
+                    self._dirty.setdefault(row[0], row)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def stats(self) -> dict:
+        return {
+            'routes': len(self._routes),
+            'conversations': len(self._last_contact),
+            'pending_writes': len(self._dirty),
+            'routed': self.routed,
+            'routed_from_header': self.from_header,
+            'writes': self.writes,
+        }
+
+
+class OpenConversation(MessageFilter):
+    """Messages from users who have talked to an admin within OPEN_DAYS."""
+
+    def filter(self, message):
+        return routes.is_open(message.chat_id)
+
+
+routes = RelayRoutes()
@@ -0,0 +1,113 @@
+import logging
+import time
+
+from db import get_connection, transaction
+
+logger = logging.getLogger(__name__)
+
+# Raw audit rows older than this are deleted once rolled up.
+RETENTION_DAYS = 90
+# Rows rolled up / deleted per transaction, so writers never wait long.
+BATCH_SIZE = 2000
+# Pause between batches to let queued writers in.
+BATCH_PAUSE = 0.05
+# Free pages returned to the OS per run.
+VACUUM_PAGES = 2000
+
+ROLLUP_WATERMARK = 'actions_rollup_id'
+
+# ------------------------- ROLLUP -------------------------
+
+def _watermark(conn) -> int:
+    row = conn.execute('SELECT value FROM maintenance_state WHERE name = ?', (ROLLUP_WATERMARK,)).fetchone()
+    return row[0] if row else 0
+
+
+def rollup_actions(batch_size: int = BATCH_SIZE) -> int:
+    """
+    Adds raw `actions` rows not yet counted into `action_daily`, batch by
+    batch, advancing a watermark in the same transaction. Returns rows rolled up.
+    """
+    total = 0
+    while True:
+        with transaction() as conn:
+            # Take the write lock up front so the batch bounds can't go stale.
+            conn.execute('BEGIN IMMEDIATE')
+            start = _watermark(conn)
+            rows, end = conn.execute('''SELECT COUNT(*), MAX(id) FROM (
+                                            SELECT id FROM actions WHERE id > ? ORDER BY id LIMIT ?)''',
+                                     (start, batch_size)).fetchone()
+            if end is None:
+                return total
+            conn.execute('''INSERT INTO action_daily (day, action, count)
+                            SELECT date(timestamp), action, COUNT(*)
+                            FROM actions
+                            WHERE id > ? AND id <= ?
+                            GROUP BY date(timestamp), action
+                            ON CONFLICT(day, action) DO UPDATE SET count = count + excluded.count''',
+                         (start, end))
+            conn.execute('''INSERT INTO maintenance_state (name, value) VALUES (?, ?)
+                            ON CONFLICT(name) DO UPDATE SET value = excluded.value''',
+                         (ROLLUP_WATERMARK, end))
+        total += rows
+        time.sleep(BATCH_PAUSE)
+
+# ------------------------- RETENTION -------------------------
+
+def purge_actions(retention_days: int = RETENTION_DAYS, batch_size: int = BATCH_SIZE) -> int:
+    """Deletes rolled-up raw actions older than the retention window in small batches."""
+    deleted = 0
+    while True:
+        with transaction() as conn:
+            watermark = _watermark(conn)
+            count = conn.execute('''DELETE FROM actions WHERE id IN (
+                                        SELECT id FROM actions
+                                        WHERE timestamp < datetime('now', ?) AND id <= ?
+                                        LIMIT ?)''',
+                                 (f'-{retention_days} days', watermark, batch_size)).rowcount
+        deleted += count
+        if count < batch_size:
+            return deleted
+        time.sleep(BATCH_PAUSE)
+
+
+def incremental_vacuum(pages: int = VACUUM_PAGES) -> int:
+    """Returns up to `pages` free pages to the OS. Needs auto_vacuum=INCREMENTAL."""
+    conn = get_connection()
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        return 0
+    free_before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    # execute() stops after one step for statements without result columns,
+    # which would free a single page; executescript runs it to completion.
+    conn.executescript(f'PRAGMA incremental_vacuum({int(pages)});')
+    return free_before - conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+
+def enable_incremental_vacuum():
+    """
+    Switches an existing database to auto_vacuum=INCREMENTAL. This rewrites the
+    whole file with VACUUM, so run it in a maintenance window, not from a job.
+    """
+    conn = get_connection()
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    conn.execute('VACUUM')
+
+
+def run_retention(retention_days: int = RETENTION_DAYS) -> dict:
+    t0 = time.perf_counter()
+    rolled_up = rollup_actions()
+    deleted = purge_actions(retention_days)
+    freed = incremental_vacuum()
+    result = {'rolled_up': rolled_up, 'deleted': deleted, 'freed_pages': freed,
+              'seconds': round(time.perf_counter() - t0, 3)}
+    logger.info(f"Audit log retention: {result}")
+    return result
+
+
+def retention_job(context):
+    """JobQueue callback; the retention window comes from job.context if set."""
+    retention_days = context.job.context or RETENTION_DAYS
+    try:
+        run_retention(retention_days)
+    except Exception as e:
+        logger.error(f"Audit log retention failed: {e}", exc_info=True)
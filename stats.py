@@ -0,0 +1,49 @@
+from db import get_connection
+from retention import ROLLUP_WATERMARK
+
+DAILY_ACTIONS_SQL = '''
+    SELECT day, action, SUM(count) FROM (
+        SELECT day, action, count FROM action_daily
+        WHERE day >= date('now', ?)
+        UNION ALL
+        SELECT date(timestamp), action, COUNT(*) FROM actions
+        WHERE id > ? AND timestamp >= date('now', ?)
+        GROUP BY date(timestamp), action
+    )
+    GROUP BY day, action
+    ORDER BY day DESC, action
+'''
+
+
+def is_accepted(status: str) -> bool:
+    # Review handlers have written 'accepted', 'accepted ✅', '✅ Accepted' and 'approved'.
+    status = (status or '').lower()
+    return 'accept' in status or 'approv' in status
+
+
+def get_application_stats() -> dict:
+    """
+    Applicant counts and summed weekly_earning per status of each user's
+    latest application, read from the trigger-maintained application_stats
+    table in O(number of statuses).
+    """
+    rows = get_connection().execute(
+        'SELECT status, applications, weekly_earning FROM application_stats WHERE applications > 0'
+    ).fetchall()
+    by_status = {status or 'unknown': (count, earning) for status, count, earning in rows}
+    payout = sum(earning for status, (_, earning) in by_status.items() if is_accepted(status))
+    return {'by_status': by_status, 'weekly_payout': payout,
+            'total': sum(count for count, _ in by_status.values())}
+
+
+def get_daily_actions(days: int = 7) -> list:
+    """
+    (day, action, count) for the last `days` days, newest first. Rolled-up days
+    come from action_daily; rows newer than the rollup watermark are counted
+    from actions by primary key range, so the scan is bounded by the retention
+    job interval rather than by the table size.
+    """
+    conn = get_connection()
+    row = conn.execute('SELECT value FROM maintenance_state WHERE name = ?', (ROLLUP_WATERMARK,)).fetchone()
+    watermark = row[0] if row else 0
+    return conn.execute(DAILY_ACTIONS_SQL, (f'-{days - 1} days', watermark, f'-{days - 1} days')).fetchall()
@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# main.py reads these at import time.
+os.environ.setdefault('ADMIN_CHAT_ID', '1')
+os.environ.setdefault('BOT_TOKEN', '123:abc')
+
+import db  # noqa: E402
+
+
+@pytest.fixture
+def temp_db(tmp_path, monkeypatch):
+    """Points db at a freshly migrated database under tmp_path."""
+    monkeypatch.setattr(db, 'DB_PATH', str(tmp_path / 'test.db'))
+    db.init_db()
+    yield db
+    db.close_all()
@@ -0,0 +1,108 @@
+"""
+The inline button registry in main.py: every action has a handler, its
+worst-case payload fits Telegram's 64-byte callback_data limit and decodes
+back to the same arguments, exactly one dispatcher handler picks it up, and
+admin-only buttons do nothing for anyone else.
+"""
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import pytest
+from telegram import Bot, CallbackQuery, Chat, Message, Update, User
+
+import callbacks
+import main
+import referrals
+
+# PTB's notes about workers=0 and per_message tracking don't apply here.
+pytestmark = pytest.mark.filterwarnings('ignore::UserWarning')
+
+# Largest values the keyboards can carry: Telegram ids and cursors fit in 52 bits.
+MAX_ID = 2 ** 52
+DIRECTIONS = ['next', 'prev']
+
+# Argument tuples to try for each action; every registered action needs an entry.
+SAMPLES = {
+    main.USERS_PAGE: [(direction, MAX_ID, MAX_ID) for direction in DIRECTIONS],
+    main.FIND_PAGE: [(direction, MAX_ID, MAX_ID) for direction in DIRECTIONS],
+    main.REVIEW: [(decision, MAX_ID) for decision in main.REVIEW_STATUSES],
+    main.BULK_TOGGLE: [(MAX_ID,)],
+    main.BULK_REVIEW: [(decision, target) for decision in main.REVIEW_STATUSES for target in ('page', 'selected')],
+    main.REVIEW_DONE: [()],
+    main.MESSAGE_USER: [(MAX_ID,)],
+    main.LEADERBOARD: [(referrals.LEADERBOARD_SIZE // referrals.LEADERBOARD_PAGE_SIZE,)],
+}
+
+# Payloads from before the registry, or from another version, must land on the fallback.
+STALE = ['approve_10000010', 'users_next_1_8', 'bulk_toggle_5', 'main_menu', '0r:approve:1', '1r:approve']
+
+CASES = [(action, arguments) for action, samples in SAMPLES.items() for arguments in samples]
+
+# Buttons only the admin may press; anyone else just gets told so.
+ADMIN_ACTIONS = [main.USERS_PAGE, main.FIND_PAGE, main.REVIEW, main.BULK_TOGGLE, main.BULK_REVIEW,
+                 main.MESSAGE_USER]
+ADMIN_CASES = [(action, arguments) for action in ADMIN_ACTIONS for arguments in SAMPLES[action]]
+
+
+@pytest.fixture(scope='module')
+def bot():
+    return Bot('123:abc')
+
+
+@pytest.fixture(scope='module')
+def dispatcher(bot):
+    return main.build_dispatcher(bot)
+
+
+def _update(bot, data, user_id=main.ADMIN_CHAT_ID):
+    user = User(user_id, 'User', False)
+    message = Message(1, None, Chat(user_id, 'private'), text='menu', bot=bot)
+    query = CallbackQuery('1', user, 'chat', data=data, message=message, bot=bot)
+    return Update(1, callback_query=query)
+
+
+def matching_handlers(dispatcher, update):
+    """Every handler, in any group, whose check_update accepts `update`."""
+    return [handler for group in sorted(dispatcher.handlers)
+            for handler in dispatcher.handlers[group] if handler.check_update(update)]
+
+
+@pytest.mark.parametrize('action', list(main.router.actions.values()), ids=lambda action: action.name)
+def test_action_has_samples_and_handler(action):
+    assert action in SAMPLES, 'no samples in SAMPLES'
+    assert action.code in main.router.handlers, 'no handler'
+
+
+@pytest.mark.parametrize('action, arguments', CASES,
+                         ids=[f'{action.name}{list(arguments)}' for action, arguments in CASES])
+def test_payload_round_trips_to_one_handler(bot, dispatcher, action, arguments):
+    data = action.encode(*arguments)
+    assert len(data.encode()) <= callbacks.MAX_BYTES
+    decoded = main.router.decode(data)
+    assert decoded is not None and decoded[0] is action and list(decoded[1]) == list(arguments), decoded
+    matched = matching_handlers(dispatcher, _update(bot, data))
+    assert [handler.callback for handler in matched] == [main.router.dispatch], matched
+
+
+@pytest.mark.parametrize('data', STALE)
+def test_stale_payload_falls_back(bot, dispatcher, data):
+    assert main.router.decode(data) is None
+    matched = matching_handlers(dispatcher, _update(bot, data))
+    assert [handler.callback for handler in matched] == [main.router.dispatch], matched
+
+
+@pytest.mark.parametrize('action, arguments', ADMIN_CASES,
+                         ids=[f'{action.name}{list(arguments)}' for action, arguments in ADMIN_CASES])
+def test_admin_action_refuses_other_users(bot, temp_db, monkeypatch, action, arguments):
+    calls = []
+
+    def submit(chat_id, fn, *args, **kwargs):
+        calls.append((fn, args))
+        future = Future()
+        future.set_result(None)
+        return future
+    monkeypatch.setattr(main.outbound, 'submit', submit)
+    update = _update(bot, action.encode(*arguments), user_id=main.ADMIN_CHAT_ID + 1)
+    context = SimpleNamespace(bot=bot, user_data={}, args=[])
+    main.router.dispatch(update, context)
+    assert calls == [(update.callback_query.answer, ("You are not authorized to do this.",))]
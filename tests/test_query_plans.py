@@ -0,0 +1,39 @@
+"""
+The hot queries in db.py and friends must be served by the indexes created
+in migrations.py rather than by full table scans.
+"""
+import pytest
+
+import db
+import referrals
+import relay
+import stats
+
+# (name, sql, params, index that must appear in the plan)
+HOT_QUERIES = [
+    ('get_application_status', db.APPLICATION_STATUS_SQL, (1,), 'idx_applications_telegram_id'),
+    ('update_application_status', db.UPDATE_STATUS_SQL, ('accepted', 1, 1), 'idx_applications_telegram_id'),
+    ('get_applicants_page (forward)', db.APPLICANTS_BEFORE_SQL, (100, 6), 'idx_applications_telegram_id'),
+    ('get_applicants_page (back)', db.APPLICANTS_AFTER_SQL, (100, 6), 'idx_applications_telegram_id'),
+    ('search_applicants', db.SEARCH_BEFORE_SQL, ('"abe"*', 100, 6), 'idx_applications_telegram_id'),
+    ('get_daily_actions', stats.DAILY_ACTIONS_SQL, ('-6 days', 0, '-6 days'), 'actions USING INTEGER PRIMARY KEY'),
+    ('get_referral', referrals.REFERRAL_SQL, (1,), 'idx_referrals_telegram_id'),
+    ('credit_referral (resolve)', referrals.RESOLVE_CODE_SQL, ('abc',), 'idx_referrals_code'),
+    ('credit_referral (count)', referrals.CREDIT_SQL, (1,), 'idx_referrals_telegram_id'),
+    ('get_leaderboard', referrals.LEADERBOARD_SQL, (11, 0), 'idx_referrals_invited_count'),
+    ('relay routes (load)', relay.LOAD_SQL, ('-7 days',), 'idx_conversations_last_contact'),
+    ('relay is_open (shared)', relay.LAST_CONTACT_SQL, (1,), 'INTEGER PRIMARY KEY'),
+]
+
+
+@pytest.mark.parametrize('sql, params, index', [query[1:] for query in HOT_QUERIES],
+                         ids=[query[0] for query in HOT_QUERIES])
+def test_query_uses_index(temp_db, sql, params, index):
+    plan = db.explain(sql, params)
+    assert any(index in step for step in plan), plan
+    # FTS5 lookups show up as a SCAN of the virtual table with an index number,
+    # and reading back a subquery's rows as a SCAN of the subquery.
+    full_scans = [step for step in plan
+                  if step.startswith('SCAN ') and 'USING' not in step and 'VIRTUAL TABLE INDEX' not in step
+                  and not step.startswith('SCAN (subquery')]
+    assert not full_scans, plan
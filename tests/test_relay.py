@@ -0,0 +1,38 @@
+"""RelayRoutes shared between processes: each sees conversations the other opened."""
+import time
+
+import relay
+
+
+def _routes():
+    routes = relay.RelayRoutes(flush_interval=3600)
+    routes.load(shared=True)
+    return routes
+
+
+def test_is_open_sees_conversation_opened_elsewhere(temp_db):
+    admin_lane, user_lane = _routes(), _routes()
+    try:
+        assert not user_lane.is_open(5)
+        admin_lane.open(5, 1)
+        admin_lane.flush()
+        assert user_lane.is_open(5)
+    finally:
+        admin_lane.close()
+        user_lane.close()
+
+
+def test_is_open_rereads_expired_conversation(temp_db):
+    stale = int(time.time()) - relay.OPEN_DAYS * 86400 - 60
+    with temp_db.transaction() as conn:
+        conn.execute(relay.SAVE_SQL, (5, 1, stale, None))
+    admin_lane, user_lane = _routes(), _routes()
+    try:
+        # Caches the expired contact.
+        assert not user_lane.is_open(5)
+        admin_lane.open(5, 1)
+        admin_lane.flush()
+        assert user_lane.is_open(5)
+    finally:
+        admin_lane.close()
+        user_lane.close()
@@ -0,0 +1,80 @@
+"""application_stats stays equal to a recount over each user's latest application."""
+from types import SimpleNamespace
+
+import pytest
+
+import main
+import stats
+from migrations import MIGRATIONS
+
+RECOUNT_SQL = '''
+    SELECT COALESCE(status, ''), COUNT(*), COALESCE(SUM(weekly_earning), 0)
+    FROM applications
+    WHERE id = (SELECT MAX(id) FROM applications AS newer WHERE newer.telegram_id = applications.telegram_id)
+    GROUP BY COALESCE(status, '')
+'''
+
+
+def counters(conn):
+    rows = conn.execute('SELECT status, applications, weekly_earning FROM application_stats WHERE applications > 0')
+    return sorted(rows.fetchall())
+
+
+def recount(conn):
+    return sorted(conn.execute(RECOUNT_SQL).fetchall())
+
+
+def apply(db, telegram_id, weekly_earning=100.0):
+    db.save_application({'telegram_id': telegram_id, 'full_name': 'Applicant', 'weekly_earning': weekly_earning})
+
+
+@pytest.fixture
+def conn(temp_db):
+    apply(temp_db, 1)
+    apply(temp_db, 2, 50.0)
+    temp_db.update_application_status(1, 'accepted')
+    # Applying again moves user 1 from accepted back to pending.
+    apply(temp_db, 1, 200.0)
+    apply(temp_db, 3)
+    temp_db.update_application_status(3, 'rejected')
+    return temp_db.get_connection()
+
+
+def test_counts_latest_application_per_user(conn):
+    assert counters(conn) == recount(conn) == [('pending', 2, 250.0), ('rejected', 1, 100.0)]
+    summary = stats.get_application_stats()
+    assert summary['total'] == 3 and summary['weekly_payout'] == 0
+
+
+def test_deleting_latest_application_restores_previous(temp_db, conn):
+    with temp_db.transaction() as c:
+        c.execute('DELETE FROM applications WHERE id = (SELECT MAX(id) FROM applications WHERE telegram_id = 1)')
+    assert counters(conn) == recount(conn) == [('accepted', 1, 100.0), ('pending', 1, 50.0), ('rejected', 1, 100.0)]
+
+
+def test_older_applications_do_not_count(temp_db, conn):
+    with temp_db.transaction() as c:
+        c.execute("UPDATE applications SET status = 'approved' WHERE telegram_id = 1 AND id = 1")
+        c.execute('DELETE FROM applications WHERE id = 1')
+    assert counters(conn) == recount(conn)
+
+
+def test_migration_rebuilds_counters(temp_db, conn):
+    with temp_db.transaction() as c:
+        c.execute('UPDATE application_stats SET applications = 99')
+        for statement in dict(MIGRATIONS)[11]:
+            c.execute(statement)
+    assert counters(conn) == recount(conn)
+
+
+def test_long_stats_message_drops_whole_lines(temp_db, monkeypatch):
+    sent = []
+    days = [(f'2026-01-{day:02}', f'action_{n}', n) for day in range(1, 29) for n in range(20)]
+    monkeypatch.setattr(stats, 'get_daily_actions', lambda days_back: days)
+    monkeypatch.setattr(main, 'respond', lambda update, fn, text, **kwargs: sent.append(text))
+    monkeypatch.setattr(main, 'log_action', lambda *args: None)
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=main.ADMIN_CHAT_ID), message=SimpleNamespace(reply_text=None))
+    main.show_stats(update, SimpleNamespace(args=[]))
+    [text] = sent
+    assert len(text) <= main.MAX_MESSAGE_LENGTH
+    assert text.endswith(' 19\n')
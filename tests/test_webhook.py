@@ -0,0 +1,58 @@
+"""The /webhook route: only Telegram's requests, and only update objects, reach the ingestor."""
+import pytest
+
+import main
+
+
+class _Ingestor:
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, payload):
+        self.submitted.append(payload)
+        return 200
+
+
+class _Dedup:
+    def claim(self, update_id):
+        return True
+
+    def release(self, update_id):
+        pass
+
+
+@pytest.fixture
+def client(monkeypatch):
+    ingestor = _Ingestor()
+    monkeypatch.setattr(main, 'ingestor', ingestor)
+    monkeypatch.setattr(main, 'dedup', _Dedup())
+    client = main.app.test_client()
+    client.submitted = ingestor.submitted
+    return client
+
+
+def _post(client, body, token=None):
+    headers = {'X-Telegram-Bot-Api-Secret-Token': main.WEBHOOK_SECRET_TOKEN if token is None else token}
+    return client.post('/webhook', json=body, headers=headers)
+
+
+def test_secret_token_is_accepted_by_telegram():
+    assert all(c.isalnum() or c in '_-' for c in main.WEBHOOK_SECRET_TOKEN)
+    assert 1 <= len(main.WEBHOOK_SECRET_TOKEN) <= 256
+
+
+@pytest.mark.parametrize('token', ['', 'wrong'])
+def test_rejects_requests_without_the_secret(client, token):
+    assert _post(client, {'update_id': 1}, token).status_code == 403
+    assert client.submitted == []
+
+
+@pytest.mark.parametrize('body', [[1, 2], 'text', 5, {}, {'update_id': '1'}, {'update_id': True}])
+def test_rejects_payloads_that_are_not_updates(client, body):
+    assert _post(client, body).status_code == 400
+    assert client.submitted == []
+
+
+def test_queues_updates(client):
+    assert _post(client, {'update_id': 7}).status_code == 200
+    assert client.submitted == [{'update_id': 7}]
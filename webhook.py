@@ -0,0 +1,569 @@
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from collections import Counter, deque
+
+import db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# ------------------------- WEBHOOK INGESTION -------------------------
+
+# What to tell Telegram when the queue is full:
+#   'reject' -> HTTP 503, Telegram keeps the update and redelivers it later
+#   'drop'   -> HTTP 200, the update is discarded and counted
+OVERLOAD_REJECT = 'reject'
+OVERLOAD_DROP = 'drop'
+
+# update_ids remembered individually. After a restart, ids this close below
+# the saved high-water mark count as already seen; an id further below it
+# means Telegram started a new sequence.
+DEDUP_WINDOW = 10000
+
+# The highest update_id is written to SQLite at most this often.
+WATERMARK_FLUSH_INTERVAL = 1.0
+WATERMARK_NAME = 'webhook_update_id'
+WATERMARK_TIME_NAME = 'webhook_update_at'
+# Telegram picks the next update_id at random after a week without updates;
+# after this long the saved mark is dropped instead of trusted.
+SEQUENCE_RESET_SECONDS = 6 * 86400
+
+# Update lanes: the admin chat, users in the middle of a conversation, and
+# new sessions (/start and home menu taps), which are the cheapest to shed.
+# In the multi-process mode the admin lane is a worker process of its own.
+ADMIN_LANE = 'admin'
+LANE_CONVERSATION = 'conversation'
+LANE_NEW = 'new'
+
+# Share of worker picks each lane gets while all of them have work queued.
+LANE_WEIGHTS = {ADMIN_LANE: 8, LANE_CONVERSATION: 4, LANE_NEW: 1}
+
+# Sheddable updates are answered cheaply instead of queued once the backlog
+# across all lanes reaches this fraction of max_queue.
+SHED_AT = 0.5
+SHED_DUPLICATE = 'duplicate'
+SHED_OVERLOAD = 'overload'
+
+# How long ShardedIngestor.start() waits for worker processes to come up.
+LANE_START_TIMEOUT = 60
+# How long a /metrics scrape waits for each worker process to report.
+METRICS_SCRAPE_TIMEOUT = 2.0
+
+
+def _single_lane(update):
+    return LANE_CONVERSATION, None
+
+
+class _Chat:
+    """A chat with updates queued or being processed."""
+
+    __slots__ = ('lane', 'pending', 'busy', 'parked')
+
+    def __init__(self, lane):
+        self.lane = lane
+        self.pending = 0  # queued, parked or in flight
+        self.busy = False
+        # Updates a worker popped while another was processing this chat.
+        self.parked = deque()
+
+
+class UpdateIngestor:
+    """
+    Decouples receiving webhook updates from processing them: the HTTP handler
+    only enqueues, and a fixed pool of worker threads feeds the queues into
+    `process`, normally the dispatcher.
+
+    `classify(update)` returns (lane, coalesce_key). Each lane in `weights`
+    has its own queue of up to `max_queue` updates, and workers pick the next
+    lane by smooth weighted round robin, so admin work keeps moving while a
+    burst of /start traffic waits. Updates in a `sheddable` lane are shed
+    instead of queued when their coalesce_key is already waiting (a repeated
+    tap), or when the backlog across all lanes reaches `shed_at` * max_queue.
+    Shed updates are handed to `shed(update, reason)` for a cheap answer.
+
+    Updates of one chat (`chat_of(update)`, the raw payload's chat by
+    default) run one at a time and in arrival order. While a chat has updates
+    queued or in flight, its new ones join the same lane whatever classify
+    says, and a worker that pops an update for a chat another worker is busy
+    with parks it there; the busy worker runs it next.
+    """
+
+    def __init__(self, process, workers: int = 4, max_queue: int = 1000,
+                 overload: str = OVERLOAD_REJECT, classify=_single_lane, weights=None,
+                 sheddable=(LANE_NEW,), shed=None, shed_at: float = SHED_AT, chat_of=None):
+        if overload not in (OVERLOAD_REJECT, OVERLOAD_DROP):
+            raise ValueError(f"Unknown overload policy: {overload}")
+        self.process = process
+        self.workers = workers
+        self.max_queue = max_queue
+        self.overload = overload
+        self.classify = classify
+        self.weights = dict(weights or LANE_WEIGHTS)
+        self.sheddable = frozenset(sheddable)
+        self.shed = shed
+        self.shed_at = shed_at
+        self.chat_of = chat_of or payload_chat_id
+        self._chats = {}
+        self._queues = {lane: deque() for lane in self.weights}
+        self._queued_keys = {lane: set() for lane in self.weights}
+        self._current = {lane: 0 for lane in self.weights}
+        self._depth = 0
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._threads = []
+        self.accepted = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.processed = 0
+        self.failed = 0
+        # (lane, reason) -> updates shed
+        self.shed_counts = Counter()
+
+    def start(self):
+        self._stopping = False
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'update-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = 10.0):
+        """Lets the workers finish what is already queued, then stops them."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def submit(self, update) -> int:
+        """Queues an update and returns the HTTP status the webhook should answer with."""
+        lane, key = self.classify(update)
+        chat_id = self.chat_of(update)
+        reason = None
+        with self._cond:
+            chat = self._chats.get(chat_id) if chat_id is not None else None
+            # A conversation step that has to wait behind a new-session update
+            # is still not sheddable.
+            sheddable = lane in self.sheddable
+            if chat is not None:
+                lane = chat.lane
+                sheddable = sheddable and lane in self.sheddable
+            waiting = self._queues[lane]
+            if sheddable and key is not None and key in self._queued_keys[lane]:
+                reason = SHED_DUPLICATE
+            elif sheddable and self._depth >= self.shed_at * self.max_queue:
+                reason = SHED_OVERLOAD
+            elif len(waiting) >= self.max_queue:
+                if self.overload == OVERLOAD_DROP:
+                    self.dropped += 1
+                    return 200
+                self.rejected += 1
+                return 503
+            else:
+                waiting.append((update, key, chat_id))
+                if key is not None:
+                    self._queued_keys[lane].add(key)
+                if chat_id is not None:
+                    if chat is None:
+                        chat = self._chats[chat_id] = _Chat(lane)
+                    chat.pending += 1
+                self._depth += 1
+                self.accepted += 1
+                self._cond.notify()
+                return 200
+            self.shed_counts[lane, reason] += 1
+        if self.shed is not None:
+            try:
+                self.shed(update, reason)
+            except Exception as e:
+                logger.error(f"Failed to answer a shed update: {e}")
+        return 200
+
+    def stats(self) -> dict:
+        with self._cond:
+            lanes = {
+                lane: {
+                    'queue_depth': len(self._queues[lane]),
+                    'weight': self.weights[lane],
+                    'shed': {reason: count for (shed_lane, reason), count in self.shed_counts.items()
+                             if shed_lane == lane},
+                }
+                for lane in self.weights
+            }
+        return {
+            'lanes': lanes,
+            'queue_depth': self._depth,
+            'queue_capacity': self.max_queue * len(self.weights),
+            'active_chats': len(self._chats),
+            'workers': len(self._threads),
+            'overload_policy': self.overload,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'dropped': self.dropped,
+            'shed': sum(self.shed_counts.values()),
+            'processed': self.processed,
+            'failed': self.failed,
+        }
+
+    def _next(self):
+        """Pops the next update by smooth weighted round robin over non-empty lanes.
+        Called with the condition held and at least one update queued."""
+        best, total = None, 0
+        for lane, weight in self.weights.items():
+            if self._queues[lane]:
+                self._current[lane] += weight
+                total += weight
+                if best is None or self._current[lane] > self._current[best]:
+                    best = lane
+        self._current[best] -= total
+        update, key, chat_id = self._queues[best].popleft()
+        if key is not None:
+            self._queued_keys[best].discard(key)
+        self._depth -= 1
+        return update, chat_id
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._depth and not self._stopping:
+                    self._cond.wait()
+                if not self._depth:
+                    return
+                update, chat_id = self._next()
+                chat = self._chats.get(chat_id) if chat_id is not None else None
+                if chat is not None:
+                    if chat.busy:
+                        chat.parked.append(update)
+                        continue
+                    chat.busy = True
+            while update is not None:
+                try:
+                    self.process(update)
+                    self.processed += 1
+                except Exception as e:
+                    self.failed += 1
+                    logger.error(f"Failed to process update: {e}", exc_info=True)
+                update = None
+                if chat is not None:
+                    with self._cond:
+                        chat.pending -= 1
+                        if chat.parked:
+                            update = chat.parked.popleft()
+                        else:
+                            chat.busy = False
+                            if not chat.pending:
+                                del self._chats[chat_id]
+
+
+# ------------------------- MULTI-PROCESS -------------------------
+
+_CHAT_KEYS = ('message', 'edited_message', 'channel_post', 'edited_channel_post',
+              'my_chat_member', 'chat_member', 'chat_join_request')
+
+
+def payload_chat_id(payload: dict):
+    """
+    The chat a raw webhook update belongs to, read from the JSON so routing
+    doesn't pay for Update.de_json. Updates without a chat (inline queries,
+    payments) fall back to the sender, which is the same id for private chats.
+    """
+    for key in _CHAT_KEYS:
+        if key in payload:
+            return payload[key].get('chat', {}).get('id')
+    query = payload.get('callback_query')
+    if query is not None and query.get('message'):
+        return query['message']['chat']['id']
+    for value in payload.values():
+        if isinstance(value, dict) and 'from' in value:
+            return value['from'].get('id')
+    return None
+
+
+def _serve_metrics(conn):
+    """Answers each scrape request from the webhook process with this process's metrics."""
+    try:
+        while conn.recv() is not None:
+            conn.send(metrics.snapshot())
+    except (EOFError, OSError):
+        pass
+
+
+def _run_lane(setup, lane, lanes, updates, ready, processed, failed, metrics_conn):
+    """Worker process body: builds the bot stack with `setup`, then processes its queue."""
+    process, teardown = setup(lane, lanes)
+    threading.Thread(target=_serve_metrics, args=(metrics_conn,), name='metrics-export', daemon=True).start()
+    ready.set()
+    try:
+        while True:
+            payload = updates.get()
+            if payload is None:
+                return
+            try:
+                process(payload)
+                with processed.get_lock():
+                    processed.value += 1
+            except Exception as e:
+                with failed.get_lock():
+                    failed.value += 1
+                logger.error(f"[{lane}] Failed to process update: {e}", exc_info=True)
+    finally:
+        teardown()
+
+
+class ShardedIngestor:
+    """
+    Multi-process counterpart of UpdateIngestor. The webhook process only
+    routes: each raw update goes to one of `shards` worker processes, picked
+    by chat id, so a chat's conversation state and per-chat send queue always
+    live in the same process. Updates from `admin_chat_id` get a worker of
+    their own so reviews never wait behind user traffic.
+
+    `setup(lane, lanes)` runs in each worker process and returns
+    (process, teardown), where process takes the update's JSON payload. It
+    must be importable, as workers are spawned rather than forked.
+
+    Handlers, the bot and the database all run in the workers, so scrape()
+    asks each of them for its metrics over a pipe.
+    """
+
+    def __init__(self, setup, shards: int = 2, admin_chat_id=None, max_queue: int = 1000,
+                 overload: str = OVERLOAD_REJECT):
+        if overload not in (OVERLOAD_REJECT, OVERLOAD_DROP):
+            raise ValueError(f"Unknown overload policy: {overload}")
+        if shards < 1:
+            raise ValueError("shards must be at least 1")
+        self.setup = setup
+        self.shards = shards
+        self.admin_chat_id = admin_chat_id
+        self.max_queue = max_queue
+        self.overload = overload
+        self.lanes = [f'shard-{i}' for i in range(shards)]
+        if admin_chat_id is not None:
+            self.lanes.append(ADMIN_LANE)
+        self._context = multiprocessing.get_context('spawn')
+        self._queues = []
+        self._processes = []
+        self._processed = []
+        self._failed = []
+        self._metrics = []
+        self._metrics_lock = threading.Lock()
+        self.accepted = 0
+        self.rejected = 0
+        self.dropped = 0
+
+    def start(self):
+        """Starts one process per lane and waits until each has built its dispatcher."""
+        ctx = self._context
+        readies = []
+        for lane in self.lanes:
+            updates = ctx.Queue(self.max_queue)
+            ready = ctx.Event()
+            processed, failed = ctx.Value('q', 0), ctx.Value('q', 0)
+            metrics_conn, worker_conn = ctx.Pipe()
+            process = ctx.Process(
+                target=_run_lane,
+                args=(self.setup, lane, len(self.lanes), updates, ready, processed, failed, worker_conn),
+                name=f'update-{lane}',
+                daemon=True,
+            )
+            process.start()
+            self._queues.append(updates)
+            self._processes.append(process)
+            self._processed.append(processed)
+            self._failed.append(failed)
+            self._metrics.append(metrics_conn)
+            readies.append(ready)
+        for lane, ready in zip(self.lanes, readies):
+            if not ready.wait(LANE_START_TIMEOUT):
+                raise RuntimeError(f"Update worker {lane} did not start")
+
+    def stop(self, timeout: float = 10.0):
+        """Lets every worker finish its queue, then waits for the processes to exit."""
+        for updates in self._queues:
+            updates.put(None)
+        for process in self._processes:
+            process.join(timeout)
+        for conn in self._metrics:
+            conn.close()
+        self._queues, self._processes, self._metrics = [], [], []
+
+    def scrape(self, timeout: float = METRICS_SCRAPE_TIMEOUT) -> list:
+        """(lane, metrics.snapshot()) for every worker that answers within `timeout` seconds."""
+        results = []
+        with self._metrics_lock:
+            for lane, conn in zip(self.lanes, self._metrics):
+                try:
+                    # Drops an answer that arrived after an earlier scrape gave up on it.
+                    while conn.poll():
+                        conn.recv()
+                    conn.send(True)
+                    if conn.poll(timeout):
+                        results.append((lane, conn.recv()))
+                    else:
+                        logger.warning(f"Update worker {lane} did not report metrics")
+                except (EOFError, OSError) as e:
+                    logger.warning(f"Could not read metrics from update worker {lane}: {e}")
+        return results
+
+    def lane_for(self, payload: dict) -> int:
+        chat_id = payload_chat_id(payload)
+        if chat_id is None:
+            return 0
+        if chat_id == self.admin_chat_id:
+            return len(self.lanes) - 1
+        return chat_id % self.shards
+
+    def submit(self, payload: dict) -> int:
+        """Queues an update's JSON payload and returns the HTTP status to answer with."""
+        try:
+            self._queues[self.lane_for(payload)].put_nowait(payload)
+        except queue.Full:
+            if self.overload == OVERLOAD_DROP:
+                self.dropped += 1
+                return 200
+            self.rejected += 1
+            return 503
+        self.accepted += 1
+        return 200
+
+    def stats(self) -> dict:
+        return {
+            'lanes': {
+                lane: {
+                    'queue_depth': updates.qsize(),
+                    'alive': process.is_alive(),
+                    'processed': processed.value,
+                    'failed': failed.value,
+                }
+                for lane, updates, process, processed, failed
+                in zip(self.lanes, self._queues, self._processes, self._processed, self._failed)
+            },
+            'queue_depth': sum(updates.qsize() for updates in self._queues),
+            'queue_capacity': self.max_queue * len(self.lanes),
+            'workers': len(self._processes),
+            'overload_policy': self.overload,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'dropped': self.dropped,
+            'processed': sum(value.value for value in self._processed),
+            'failed': sum(value.value for value in self._failed),
+        }
+
+
+# ------------------------- DEDUPLICATION -------------------------
+
+class UpdateDeduplicator:
+    """
+    Recognises updates Telegram delivers more than once. The last `window`
+    claimed ids are kept in a set, with a deque to evict the oldest. A
+    background thread saves the highest id to maintenance_state every
+    `flush_interval` seconds, so request threads never write SQLite; after a
+    restart, ids up to `window` below it count as seen too.
+
+    update_ids normally grow, but Telegram restarts the sequence at a random
+    value after a week without updates. An id more than `window` below the
+    highest one, or the first id after SEQUENCE_RESET_SECONDS of silence,
+    starts over from that id instead of being dropped.
+    """
+
+    def __init__(self, window: int = DEDUP_WINDOW, flush_interval: float = WATERMARK_FLUSH_INTERVAL):
+        self.window = window
+        self.flush_interval = flush_interval
+        self._seen = set()
+        self._order = deque()
+        self._lock = threading.Lock()
+        self._restored = None
+        self._flushed = None
+        self._last_update = None
+        self._stop = threading.Event()
+        self._thread = None
+        self.high_water = None
+        self.claimed = 0
+        self.duplicates = 0
+        self.resets = 0
+
+    def load(self):
+        """Restores the high-water mark saved by the previous run and starts the writer."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='dedup-flush', daemon=True)
+            self._thread.start()
+        rows = dict(db.get_connection().execute(
+            'SELECT name, value FROM maintenance_state WHERE name IN (?, ?)',
+            (WATERMARK_NAME, WATERMARK_TIME_NAME)).fetchall())
+        with self._lock:
+            if WATERMARK_NAME not in rows or self.high_water is not None:
+                return
+            self._restored = self._flushed = self.high_water = rows[WATERMARK_NAME]
+            self._last_update = rows.get(WATERMARK_TIME_NAME)
+
+    def claim(self, update_id: int) -> bool:
+        """Returns True the first time `update_id` is seen, False for a redelivery."""
+        now = time.time()
+        with self._lock:
+            if update_id in self._seen:
+                self.duplicates += 1
+                return False
+            if self.high_water is not None and (
+                    update_id < self.high_water - self.window
+                    or (self._last_update is not None and now - self._last_update > SEQUENCE_RESET_SECONDS)):
+                logger.warning(f"update_id sequence restarted at {update_id} (was {self.high_water})")
+                self._seen.clear()
+                self._order.clear()
+                self._restored = self.high_water = None
+                self.resets += 1
+            elif self._restored is not None and update_id <= self._restored:
+                self.duplicates += 1
+                return False
+            self._seen.add(update_id)
+            self._order.append(update_id)
+            if len(self._order) > self.window:
+                self._seen.discard(self._order.popleft())
+            if self.high_water is None or update_id > self.high_water:
+                self.high_water = update_id
+            self._last_update = now
+            self.claimed += 1
+        return True
+
+    def release(self, update_id: int):
+        """Forgets a claimed update that was turned away, so its redelivery gets through."""
+        with self._lock:
+            self._seen.discard(update_id)
+
+    def flush(self):
+        with self._lock:
+            high_water, last_update = self.high_water, self._last_update
+        if high_water is None or high_water == self._flushed:
+            return
+        try:
+            # Overwritten rather than maxed: after a sequence restart the mark goes down.
+            with db.transaction() as conn:
+                conn.executemany('''INSERT INTO maintenance_state (name, value) VALUES (?, ?)
+                                    ON CONFLICT(name) DO UPDATE SET value = excluded.value''',
+                                 [(WATERMARK_NAME, high_water), (WATERMARK_TIME_NAME, int(last_update))])
+            self._flushed = high_water
+        except Exception as e:
+            logger.error(f"Failed to save the update high-water mark: {e}")
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def stats(self) -> dict:
+        return {
+            'claimed': self.claimed,
+            'duplicates': self.duplicates,
+            'high_water': self.high_water,
+            'saved_high_water': self._flushed,
+            'sequence_resets': self.resets,
+            'window': len(self._seen),
+        }